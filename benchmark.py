@@ -0,0 +1,251 @@
+import gc
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import tracemalloc
+from array import array
+from pathlib import Path
+
+import main
+
+GUILD = 1  # every benchmark runs in one guild namespace
+# =========================
+# Synthetic data
+# =========================
+FIRST = [
+    "فهد", "محمد", "عبدالله", "خالد", "سارة", "نورة", "أحمد", "ريم", "يوسف", "مشاعل", "سلطان", "هيا",
+    "ahmed", "sara", "omar", "lina", "yousef", "reem", "fahad", "noura", "khalid", "maha", "john", "anna",
+]
+LAST = [
+    "الدوسري", "العتيبي", "القحطاني", "الشمري", "الزهراني", "الغامدي", "المطيري", "الحربي",
+    "alharbi", "smith", "khan", "hassan", "alzahrani", "ali", "otaibi", "garcia",
+]
+
+def make_rows(n: int, seed: int = 1):
+    """n unique (name, code, user_id) rows shaped like real ones."""
+    rnd = random.Random(seed)
+    rows = []
+    seen = set()
+    for i in range(n):
+        name = main.normalize_name(f"{rnd.choice(FIRST)} {rnd.choice(FIRST)} {rnd.choice(LAST)}")
+        if name in seen:
+            name = f"{name} {i}"
+        seen.add(name)
+        code = f"{rnd.choice('chmk')}-{i}"
+        user_id = str(rnd.randrange(10 ** 17, 10 ** 18))
+        rows.append((name, code, user_id))
+    return rows
+
+def bulk_text(rows, single_line: bool = False):
+    # the AddModal / /bulkadd input format: "ID name code"
+    sep = " " if single_line else "\n"
+    return sep.join(f"{uid} {name} {code}" for name, code, uid in rows)
+
+def sample_queries(rows, count: int = 200, seed: int = 2):
+    rnd = random.Random(seed)
+    picks = [rnd.choice(rows) for _ in range(count)]
+    return {
+        "exact_name": [name for name, _, _ in picks],
+        "exact_code": [code.upper() for _, code, _ in picks],
+        "multi_item": [f"{a[0]} {b[1]} {c[1]}" for a, b, c in zip(picks, picks[1:], picks[2:])],
+        "prefix": [name[:max(3, len(name) // 2)] for name, _, _ in picks],
+        "typo": [name[:3] + name[4:] for name, _, _ in picks],
+        "miss": [f"zz{i}qq" for i in range(count)],
+    }
+
+# =========================
+# Timing
+# =========================
+def summarize(samples):
+    return {
+        "runs": len(samples),
+        "min_s": min(samples),
+        "median_s": statistics.median(samples),
+        "mean_s": statistics.fmean(samples),
+    }
+
+def timed(fn, repeat: int):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    return summarize(samples)
+
+async def atimed(fn, repeat: int):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        await fn()
+        samples.append(time.perf_counter() - t0)
+    return summarize(samples)
+
+def per_query(fn, queries, repeat: int):
+    result = timed(lambda: [fn(q) for q in queries], repeat)
+    result["per_query_us"] = result["median_s"] / len(queries) * 1e6
+    return result
+
+def use_db(path: str):
+    # point the DB layer at a fresh file (threads hold their own connections)
+    main.stop_db()
+    main.DB_PATH = path
+    main.caches.clear()  # caches and revs of the previous file do not apply
+    main._latest_rev.clear()
+    main.start_db()
+
+async def bench_size(n: int, repeat: int, workdir: str):
+    rows = make_rows(n)
+    text = bulk_text(rows)
+    single = bulk_text(rows, single_line=True)
+    out = {}
+
+    out["parse_multiline"] = timed(lambda: main.parse_bulk_any(text), repeat)
+    out["parse_single_line"] = timed(lambda: main.parse_bulk_any(single), repeat)
+
+    use_db(str(Path(workdir) / f"bench_{n}.db"))
+    await main.init_db()
+    await main.load_cache(GUILD)
+
+    t0 = time.perf_counter()
+    await main.bulk_upsert(GUILD, text)
+    out["ingest_fresh"] = summarize([time.perf_counter() - t0])
+    out["ingest_replace"] = await atimed(lambda: main.bulk_upsert(GUILD, text), repeat)
+    out["load_cache"] = await atimed(lambda: main.load_cache(GUILD), repeat)
+
+    cache = await main.get_cache(GUILD)
+    for kind, queries in sample_queries(rows).items():
+        out[f"lookup_{kind}"] = per_query(lambda q: main.lookup_records(cache, q), queries, repeat)
+
+    out["list_all_records"] = await atimed(lambda: main.list_all_records(GUILD), repeat)
+    for fmt, gz in (("tsv", False), ("csv", False), ("jsonl", True)):
+        name = f"export_{fmt}" + ("_gz" if gz else "")
+
+        async def export():
+            writer = await main.db_read(main._export_parts, GUILD, fmt, gz, main.EXPORT_DEFAULT_LIMIT)
+            for part in writer.parts:
+                part.close()
+
+        out[name] = await atimed(export, repeat)
+    return out
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True, cwd=Path(__file__).parent
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def bench_timing(sizes, repeat: int):
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            for n in sizes:
+                print(f"⏱️ {n} rows...")
+                results[str(n)] = await bench_size(n, repeat, workdir)
+        finally:
+            main.stop_db()
+    return results
+
+def print_table(results, baseline=None):
+    for size, benches in results.items():
+        print(f"\n== {size} rows ==")
+        for name, r in benches.items():
+            line = f"{name:<22} {r['median_s'] * 1000:>10.3f} ms"
+            if "per_query_us" in r:
+                line += f"  ({r['per_query_us']:.1f} µs/query)"
+            old = (baseline or {}).get(size, {}).get(name)
+            if old:
+                line += f"  x{r['median_s'] / old['median_s']:.2f} vs baseline"
+            print(line)
+
+# =========================
+# Memory
+# =========================
+def legacy_cache(rows):
+    # the old layout: (name, code, user_id) tuples in two dicts
+    cache_name, cache_code = {}, {}
+    for name, code, uid in rows:
+        rec = (name, code, str(uid))
+        cache_name[name] = rec
+        cache_code[code] = rec
+    return cache_name, cache_code
+
+def record_store(rows):
+    store = main.RecordStore()
+    store.extend(rows)
+    return store
+
+def guild_cache(rows):
+    # everything a loaded guild holds: the store, its search index and the list order
+    store = record_store(rows)
+    order = array("I", main.sorted_in_steps(list(store.rows()), store.order_key))
+    return main.GuildCache(GUILD, store, main._build_index(store), order, None)
+
+def measure(build, rows) -> int:
+    """Bytes still allocated by build(rows) once it returns."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    # fresh copies of the strings, traced: what the structure keeps of them counts, like after a DB load
+    rows = [(n.encode().decode(), c.encode().decode(), u.encode().decode()) for n, c, u in rows]
+    result = build(rows)
+    del rows
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after - before
+
+def bench_memory(sizes):
+    # the store replaces the old dicts; the search index and list order are new on top of it
+    print(f"{'rows':>10} {'dicts MB':>10} {'store MB':>10} {'saved':>7} {'index+order MB':>15}")
+    for n in sizes:
+        rows = make_rows(n)
+        old = measure(legacy_cache, rows)
+        store = measure(record_store, rows)
+        extra = measure(guild_cache, rows) - store
+        print(f"{n:>10} {old / 2**20:>10.1f} {store / 2**20:>10.1f} {1 - store / old:>7.0%} {extra / 2**20:>15.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the IDs bot (no Discord connection needed)")
+    sub = parser.add_subparsers(dest="cmd")
+
+    p_time = sub.add_parser("timing", help="parse / ingest / lookup / list / export timings")
+    p_time.add_argument("--sizes", default="1000,10000,100000", help="comma separated row counts")
+    p_time.add_argument("--repeat", type=int, default=3)
+    p_time.add_argument("--out", default="bench_results.json", help="where to write the JSON results")
+    p_time.add_argument("--compare", help="earlier results JSON to compare against")
+
+    p_mem = sub.add_parser("memory", help="guild cache (store, search index, list order) vs the old dict cache")
+    p_mem.add_argument("--sizes", default="10000,100000,1000000", help="comma separated row counts")
+
+    args = parser.parse_args()
+    if args.cmd == "memory":
+        bench_memory([int(x) for x in args.sizes.split(",")])
+    elif args.cmd == "timing":
+        sizes = [int(x) for x in args.sizes.split(",")]
+        results = asyncio.run(bench_timing(sizes, args.repeat))
+        baseline = None
+        if args.compare:
+            baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))["results"]
+        print_table(results, baseline)
+        report = {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "repeat": args.repeat,
+            "results": results,
+        }
+        Path(args.out).write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+        print(f"\n📄 {args.out}")
+    else:
+        parser.print_help()
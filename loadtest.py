@@ -0,0 +1,352 @@
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import platform
+import tempfile
+from pathlib import Path
+
+import discord
+
+import main
+from benchmark import GUILD, make_rows, bulk_text, sample_queries, use_db, git_commit
+
+# =========================
+# Fake Discord objects
+# =========================
+# Just enough of Interaction / Context for the handlers in main.py; replies are
+# recorded instead of sent, after an optional simulated API round trip.
+API_DELAY = 0.0  # seconds per fake Discord call (--api-ms)
+
+async def api_call():
+    # a real reply always suspends the handler, even at --api-ms 0
+    await asyncio.sleep(API_DELAY)
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.filesize_limit = main.EXPORT_DEFAULT_LIMIT
+
+    def get_channel(self, channel_id: int):
+        return None
+
+class FakeUser:
+    _ids = itertools.count(10 ** 17)
+
+    def __init__(self, admin: bool = False):
+        self.id = next(self._ids)
+        self.guild_permissions = discord.Permissions(administrator=admin)
+
+class FakeResponse:
+    def __init__(self, interaction: "FakeInteraction"):
+        self._interaction = interaction
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def _respond(self, kind: str, **kwargs):
+        if self._done:
+            raise discord.InteractionResponded(self._interaction)
+        self._done = True
+        await api_call()
+        self._interaction.sent.append((kind, kwargs))
+
+    async def send_message(self, content=None, **kwargs):
+        await self._respond("send", content=content, **kwargs)
+
+    async def defer(self, **kwargs):
+        await self._respond("defer", **kwargs)
+
+    async def edit_message(self, **kwargs):
+        await self._respond("edit", **kwargs)
+
+    async def send_modal(self, modal):
+        await self._respond("modal", modal=modal)
+
+class FakeFollowup:
+    def __init__(self, interaction: "FakeInteraction"):
+        self._interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        await api_call()
+        self._interaction.sent.append(("followup", dict(content=content, **kwargs)))
+
+class FakeInteraction:
+    _ids = itertools.count(1)
+
+    def __init__(self, guild: FakeGuild, user: FakeUser, channel_id: int = 1):
+        self.id = next(self._ids)
+        self.application_id = 1
+        self.token = f"fake-{self.id}"
+        self.guild = guild
+        self.guild_id = guild.id
+        self.channel_id = channel_id
+        self.user = user
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.sent = []
+
+    async def edit_original_response(self, **kwargs):
+        await api_call()
+        self.sent.append(("edit_original", kwargs))
+
+class FakeContext:
+    def __init__(self, guild: FakeGuild, user: FakeUser):
+        self.guild = guild
+        self.author = user
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        await api_call()
+        self.sent.append(("send", dict(content=content, **kwargs)))
+
+# =========================
+# Handler drivers
+# =========================
+def button(view: discord.ui.View, custom_id: str):
+    return next(item for item in view.children if getattr(item, "custom_id", None) == custom_id)
+
+def submitted(modal: discord.ui.Modal, interaction, text: str):
+    # what discord.py does with the modal_submit payload
+    modal.data._refresh_state(interaction, {"value": text})
+    return modal
+
+class Driver:
+    """Runs handlers against fake interactions and records latency per handler."""
+
+    def __init__(self, guild: FakeGuild):
+        self.guild = guild
+        self.samples = {}  # handler -> [seconds]
+        self.errors = {}  # handler -> count (raised, or never answered)
+
+    async def run(self, name: str, fn, target):
+        t0 = time.perf_counter()
+        try:
+            await fn()
+            ok = bool(target.sent)
+        except Exception as e:
+            ok = False
+            print(f"⚠️ {name}: {e!r}")
+        self.samples.setdefault(name, []).append(time.perf_counter() - t0)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def interaction(self, admin: bool = False):
+        return FakeInteraction(self.guild, FakeUser(admin))
+
+    async def slash_ids(self, query: str):
+        it = self.interaction()
+        await self.run("slash:ids", lambda: main.slash_ids.callback(it, query), it)
+
+    async def prefix_ids(self, query: str):
+        ctx = FakeContext(self.guild, FakeUser())
+        await self.run("prefix:ids", lambda: main.prefix_ids.callback(ctx, query=query), ctx)
+
+    async def slash_bulkadd(self, data: str):
+        it = self.interaction(admin=True)
+        await self.run("slash:bulkadd", lambda: main.slash_bulkadd.callback(it, data), it)
+
+    async def panel_button(self, custom_id: str, admin: bool = False):
+        it = self.interaction(admin)
+        item = button(main.PanelView(), custom_id)
+        await self.run(f"button:{custom_id.split(':')[1]}", lambda: item.callback(it), it)
+
+    async def list_next(self):
+        # the Next button of the first list page, as a user pages through
+        records, _, _ = main.list_page(await main.get_cache(self.guild.id))
+        kind, key = main._cursor_of(records[-1])
+        it = self.interaction()
+        item = main.ListPageButton("n", kind, key)
+        await self.run("button:list_page", lambda: item.callback(it), it)
+
+    async def add_modal(self, text: str):
+        it = self.interaction(admin=True)
+        modal = submitted(main.AddModal(), it, text)
+        await self.run("modal:add", lambda: modal.on_submit(it), it)
+
+    async def delete_modal(self, text: str):
+        it = self.interaction(admin=True)
+        modal = submitted(main.DeleteModal(), it, text)
+        await self.run("modal:delete", lambda: modal.on_submit(it), it)
+
+# =========================
+# Scenarios
+# =========================
+class LagProbe:
+    """Samples how late a short sleep wakes up, i.e. how long the loop was blocked."""
+
+    INTERVAL = 0.005
+
+    def __init__(self):
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            t0 = loop.time()
+            await asyncio.sleep(self.INTERVAL)
+            self.samples.append(max(0.0, loop.time() - t0 - self.INTERVAL))
+
+    def __enter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+
+def percentile(samples, p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] if ordered else 0.0
+
+async def users(count: int, rounds: int, op):
+    """count concurrent users, each doing op(user, round) rounds times back to back."""
+    async def one(u):
+        for r in range(rounds):
+            await op(u, r)
+    await asyncio.gather(*(one(u) for u in range(count)))
+
+def scenarios(rows, args):
+    queries = [q for qs in sample_queries(rows, count=100).values() for q in qs]
+    rnd = random.Random(3)
+    fresh = make_rows(args.bulk_rows, seed=7)
+
+    def ids(d, u, r):
+        return d.slash_ids(rnd.choice(queries))
+
+    def entries(n):
+        picked = rnd.sample(fresh, n)
+        return bulk_text(picked), "\n".join(code for _, code, _ in picked)
+
+    async def ids_only(d):
+        await users(args.users, args.rounds, lambda u, r: ids(d, u, r))
+
+    async def ids_during_bulkadd(d):
+        await asyncio.gather(
+            users(args.users, args.rounds, lambda u, r: ids(d, u, r)),
+            d.slash_bulkadd(bulk_text(fresh)),
+        )
+
+    async def prefix_only(d):
+        await users(args.users, args.rounds, lambda u, r: d.prefix_ids(rnd.choice(queries)))
+
+    async def panel(d):
+        actions = [
+            lambda: d.panel_button("panel:list"),
+            d.list_next,
+            lambda: d.panel_button("panel:add", admin=True),
+            lambda: d.panel_button("panel:delete", admin=True),
+        ]
+
+        async def op(u, r):
+            await actions[(u + r) % len(actions)]()
+        await asyncio.gather(
+            users(args.users, args.rounds, op),
+            users(2, 2, lambda u, r: d.panel_button("panel:export")),
+        )
+
+    async def modals(d):
+        async def op(u, r):
+            text, keys = entries(20)
+            await (d.add_modal(text) if r % 2 == 0 else d.delete_modal(keys))
+        await users(max(1, args.users // 5), args.rounds, op)
+
+    async def mixed(d):
+        await asyncio.gather(ids_during_bulkadd(d), prefix_only(d), panel(d), modals(d))
+
+    return {
+        "ids": ids_only,
+        "ids_during_bulkadd": ids_during_bulkadd,
+        "prefix_ids": prefix_only,
+        "panel": panel,
+        "modals": modals,
+        "mixed": mixed,
+    }
+
+async def run_scenario(name: str, scenario, guild: FakeGuild):
+    driver = Driver(guild)
+    with LagProbe() as lag:
+        t0 = time.perf_counter()
+        await scenario(driver)
+        wall = time.perf_counter() - t0
+    await main.journal.flush()
+    ops = sum(len(s) for s in driver.samples.values())
+    return {
+        "wall_s": wall,
+        "ops": ops,
+        "ops_per_s": ops / wall if wall else 0.0,
+        "lag_p50_ms": percentile(lag.samples, 50) * 1000,
+        "lag_p99_ms": percentile(lag.samples, 99) * 1000,
+        "lag_max_ms": max(lag.samples, default=0.0) * 1000,
+        "handlers": {
+            handler: {
+                "n": len(samples),
+                "errors": driver.errors.get(handler, 0),
+                "p50_ms": percentile(samples, 50) * 1000,
+                "p99_ms": percentile(samples, 99) * 1000,
+                "max_ms": max(samples) * 1000,
+            }
+            for handler, samples in sorted(driver.samples.items())
+        },
+    }
+
+async def run_all(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        use_db(str(Path(workdir) / "loadtest.db"))
+        try:
+            await main.init_db()
+            await main.load_panels()
+            rows = make_rows(args.rows)
+            await main.bulk_upsert(GUILD, bulk_text(rows))
+            await main.get_cache(GUILD)
+            guild = FakeGuild(GUILD)
+            picked = scenarios(rows, args)
+            for name in args.scenarios.split(",") if args.scenarios else picked:
+                print(f"🏃 {name}...")
+                results[name] = await run_scenario(name, picked[name], guild)
+        finally:
+            await main.journal.flush()
+            main.stop_db()
+    return results
+
+def print_report(results):
+    for name, r in results.items():
+        print(
+            f"\n== {name} ==  {r['ops']} ops in {r['wall_s']:.2f}s ({r['ops_per_s']:.0f}/s)"
+            f"  loop lag p50 {r['lag_p50_ms']:.1f} ms, p99 {r['lag_p99_ms']:.1f} ms, max {r['lag_max_ms']:.1f} ms"
+        )
+        for handler, h in r["handlers"].items():
+            errors = f"  ❌ {h['errors']}" if h["errors"] else ""
+            print(
+                f"{handler:<20} {h['n']:>6}  p50 {h['p50_ms']:>8.2f} ms  p99 {h['p99_ms']:>8.2f} ms"
+                f"  max {h['max_ms']:>8.2f} ms{errors}"
+            )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent load test of the bot's handlers (no Discord connection needed)")
+    parser.add_argument("--rows", type=int, default=100000, help="records in the guild before the run")
+    parser.add_argument("--users", type=int, default=50, help="concurrent users per scenario")
+    parser.add_argument("--rounds", type=int, default=20, help="actions per user")
+    parser.add_argument("--bulk-rows", type=int, default=2000, help="rows in the admin's /bulkadd")
+    parser.add_argument("--api-ms", type=float, default=0.0, help="simulated Discord API round trip per reply")
+    parser.add_argument("--scenarios", help="comma separated subset (default: all)")
+    parser.add_argument("--out", default="loadtest_results.json", help="where to write the JSON results")
+    args = parser.parse_args()
+
+    API_DELAY = args.api_ms / 1000
+    results = asyncio.run(run_all(args))
+    print_report(results)
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "args": vars(args),
+        "results": results,
+    }
+    Path(args.out).write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"\n📄 {args.out}")
@@ -1,50 +1,449 @@
 import os
+import sys
 import re
+import csv
+import codecs
+import gzip
+import json
+import mmap
+import hashlib
+import hmac
 import time
+import random
+import heapq
+import queue
+import signal
 import sqlite3
 import asyncio
-from io import BytesIO
-from threading import Thread
-
+import functools
+import contextvars
+import tempfile
+from io import BytesIO, StringIO
+from datetime import datetime, timezone
+from array import array
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right, insort
+from threading import Lock, Thread, local
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from aiohttp import web
 import discord
 from discord.ext import commands
 from discord import app_commands
 
-from flask import Flask
-
 # =========================
-# Keep Alive (Render)
+# Settings
 # =========================
-app = Flask(__name__)
+DB_PATH = "data.db"
 
-@app.get("/")
-def home():
-    return "Bot is alive!"
+# حطهم في Render Environment Variables
+# The panel of each guild is stored in the DB (guild_panels, set by /panel); these env
+# values are the fallback for the guild that owns PANEL_CHANNEL_ID.
+PANEL_CHANNEL_ID = int(os.getenv("PANEL_CHANNEL_ID", "0") or "0")
+PANEL_MESSAGE_ID = int(os.getenv("PANEL_MESSAGE_ID", "0") or "0")
+# Guild that rows from before per-guild storage belong to (0 = unassigned: adopted on
+# login when the bot is in one guild, else by !adopt in the right server)
+GUILD_ID = int(os.getenv("GUILD_ID", "0") or "0")
+# Bearer token for the HTTP lookup API; the API is off while it is unset
+API_TOKEN = os.getenv("API_TOKEN", "")
 
-def run_web():
-    port = int(os.getenv("PORT", "10000"))
-    app.run(host="0.0.0.0", port=port)
+# =========================
+# Metrics (Prometheus text on /metrics)
+# =========================
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+LAG_INTERVAL = 0.5  # seconds between event-loop lag probes
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, le in enumerate(self.buckets):
+            if value <= le:
+                self.counts[i] += 1
+
+    def render(self, name: str, labels: str = ""):
+        sep = "," if labels else ""
+        out = []
+        for le, n in zip(self.buckets, self.counts):
+            out.append(f'{name}_bucket{{{labels}{sep}le="{le}"}} {n}')
+        out.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ""
+        out.append(f"{name}_sum{suffix} {self.sum}")
+        out.append(f"{name}_count{suffix} {self.count}")
+        return out
+
+class Metrics:
+    """Per-handler counters and histograms, written on the loop and read by /metrics."""
+
+    COUNTERS = (
+        ("calls", "bot_handler_calls_total", "Handler invocations"),
+        ("errors", "bot_handler_errors_total", "Handler invocations that raised"),
+        ("rows", "bot_handler_rows_total", "Records read or written by the handler"),
+        ("db", "bot_handler_db_seconds_total", "Time the handler spent waiting on SQLite"),
+        ("api", "bot_handler_discord_api_seconds_total", "Time the handler spent in Discord HTTP calls"),
+    )
 
-Thread(target=run_web, daemon=True).start()
+    def __init__(self):
+        self.lock = Lock()
+        self.latency = {}
+        self.counters = {key: {} for key, _, _ in self.COUNTERS}
+        self.loop_lag = Histogram(LAG_BUCKETS)
+        self.loop_lag_max = 0.0
+        self.gauges = {}  # name -> (help, callable)
+
+    def observe(self, handler: str, seconds: float, stats: dict, error: bool):
+        with self.lock:
+            hist = self.latency.get(handler)
+            if hist is None:
+                hist = self.latency[handler] = Histogram(LATENCY_BUCKETS)
+            hist.observe(seconds)
+            values = {"calls": 1, "errors": int(error), **stats}
+            for key, _, _ in self.COUNTERS:
+                bucket = self.counters[key]
+                bucket[handler] = bucket.get(handler, 0) + values.get(key, 0)
+
+    def observe_lag(self, seconds: float):
+        with self.lock:
+            self.loop_lag.observe(seconds)
+            self.loop_lag_max = max(self.loop_lag_max, seconds)
+
+    def gauge(self, name: str, help_text: str, fn, kind: str = "gauge"):
+        self.gauges[name] = (help_text, fn, kind)
+
+    def render(self) -> str:
+        with self.lock:
+            out = [
+                "# HELP bot_handler_latency_seconds Handler latency",
+                "# TYPE bot_handler_latency_seconds histogram",
+            ]
+            for handler, hist in sorted(self.latency.items()):
+                out += hist.render("bot_handler_latency_seconds", f'handler="{handler}"')
+            for key, name, help_text in self.COUNTERS:
+                out += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for handler, value in sorted(self.counters[key].items()):
+                    out.append(f'{name}{{handler="{handler}"}} {value}')
+            out += [
+                "# HELP bot_event_loop_lag_seconds How late the loop woke a sleeping probe",
+                "# TYPE bot_event_loop_lag_seconds histogram",
+            ]
+            out += self.loop_lag.render("bot_event_loop_lag_seconds")
+            out += [
+                "# HELP bot_event_loop_lag_max_seconds Worst loop lag seen",
+                "# TYPE bot_event_loop_lag_max_seconds gauge",
+                f"bot_event_loop_lag_max_seconds {self.loop_lag_max}",
+            ]
+        for name, (help_text, fn, kind) in sorted(self.gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            out += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+metrics.gauge("bot_records", "Records held in memory", lambda: sum(c.store.count for c in list(caches.values())))
+metrics.gauge("bot_guild_caches", "Guild caches loaded in memory", lambda: len(caches))
+_handler_stats = contextvars.ContextVar("handler_stats", default=None)
+
+def _add_stat(key: str, value):
+    stats = _handler_stats.get()
+    if stats is not None:
+        stats[key] += value
+
+def count_rows(n: int):
+    _add_stat("rows", n)
+
+def instrumented(name: str):
+    """Time a command/callback and attribute its DB and Discord API time to `name`."""
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            stats = {"rows": 0, "db": 0.0, "api": 0.0}
+            token = _handler_stats.set(stats)
+            t0 = time.perf_counter()
+            error = False
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                _handler_stats.reset(token)
+                metrics.observe(name, time.perf_counter() - t0, stats, error)
+        return wrapper
+    return deco
+
+async def _trace_start(session, ctx, params):
+    ctx.started = time.perf_counter()
+
+async def _trace_end(session, ctx, params):
+    _add_stat("api", time.perf_counter() - ctx.started)
+
+# every Discord HTTP call (REST, interaction responses, followups) goes through this session
+http_trace = aiohttp.TraceConfig()
+http_trace.on_request_start.append(_trace_start)
+http_trace.on_request_end.append(_trace_end)
+http_trace.on_request_exception.append(_trace_end)
+
+async def watch_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        metrics.observe_lag(max(0.0, loop.time() - t0 - LAG_INTERVAL))
 
 # =========================
-# Settings
+# Outbound scheduler (rate limits)
 # =========================
-DB_PATH = "data.db"
+RATE_DEFAULT = 5           # requests per RATE_PER seconds on a route Discord has not described yet
+RATE_PER = 5.0
+RATE_WAIT_MAX = 30.0       # longer limits raise discord.RateLimited instead of blocking a request
+RATE_ATTEMPTS = 5
+RATE_BACKOFF_BASE = 1.0
+RATE_BACKOFF_MAX = 600.0
+RATE_IDLE = 600.0          # seconds a route goes unused before its limit state is forgotten
+_MAJOR_SEGMENTS = ("channels", "guilds", "webhooks")
+_API_PREFIX = re.compile(r"^/api/v\d+")
+
+def route_key(method: str, path: str) -> str:
+    """Rate limit route of a request: snowflakes other than the major parameter become :id.
+
+    Webhook and interaction tokens stay: Discord limits each token on its
+    own (webhook ID + token is a major parameter). The routes they make
+    are forgotten once idle, see RATE_IDLE.
+    """
+    parts = _API_PREFIX.sub("", path).split("/")
+    for i, part in enumerate(parts):
+        if part.isdigit() and not (i == 2 and parts[1] in _MAJOR_SEGMENTS):
+            parts[i] = ":id"
+    return f"{method.upper()} {'/'.join(parts)}"
+
+def jittered(seconds: float) -> float:
+    return seconds * random.uniform(1.0, 1.25)
+
+class RateLimits:
+    """What Discord's X-RateLimit-* headers last said, fed by the HTTP trace."""
 
-# حطهم في Render Environment Variables
-PANEL_CHANNEL_ID = int(os.getenv("PANEL_CHANNEL_ID", "0") or "0")
-PANEL_MESSAGE_ID = int(os.getenv("PANEL_MESSAGE_ID", "0") or "0")
+    def __init__(self):
+        self.bucket_of = {}  # route -> (bucket hash, monotonic time last seen)
+        self.buckets = {}    # bucket hash -> (remaining, reset monotonic time)
+        self.global_until = 0.0
+        self.hits_429 = 0
+        self._pruned = time.monotonic()
+
+    def update(self, method: str, path: str, status: int, headers):
+        now = time.monotonic()
+        self._prune(now)
+        route = route_key(method, path)
+        bucket = headers.get("X-RateLimit-Bucket")
+        if bucket:
+            self.bucket_of[route] = (bucket, now)
+            try:
+                remaining = int(headers.get("X-RateLimit-Remaining", "1"))
+                reset_after = float(headers.get("X-RateLimit-Reset-After", "0"))
+            except ValueError:
+                remaining, reset_after = 1, 0.0
+            self.buckets[bucket] = (remaining, now + reset_after)
+        if status == 429:
+            self.hits_429 += 1
+            retry = _retry_after(headers) or RATE_BACKOFF_BASE
+            if headers.get("X-RateLimit-Global") or headers.get("X-RateLimit-Scope") == "global":
+                self.global_until = max(self.global_until, now + retry)
+            elif bucket:
+                self.buckets[bucket] = (0, now + retry)
+
+    def delay(self, route: str) -> float:
+        """Seconds until the bucket behind route has room again (0 = go)."""
+        now = time.monotonic()
+        wait = self.global_until - now
+        bucket = self.bucket_of.get(route)
+        state = self.buckets.get(bucket[0]) if bucket is not None else None
+        if state is not None and state[0] <= 0:
+            wait = max(wait, state[1] - now)
+        return max(0.0, wait)
+
+    def _prune(self, now: float):
+        # routes unused for RATE_IDLE are learnt again on their next response;
+        # a bucket past its reset no longer holds anything back
+        if now - self._pruned < RATE_IDLE:
+            return
+        self._pruned = now
+        self.bucket_of = {route: b for route, b in self.bucket_of.items() if now - b[1] < RATE_IDLE}
+        self.buckets = {bucket: s for bucket, s in self.buckets.items() if s[1] > now}
+
+def _retry_after(headers):
+    try:
+        return float(headers.get("Retry-After") or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+class TokenBucket:
+    def __init__(self, rate: int = RATE_DEFAULT, per: float = RATE_PER):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Reserve a token; returns how long to wait before using it."""
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens * self.per / self.rate
+
+class _Job:
+    __slots__ = ("factory", "future")
+
+    def __init__(self, factory, future):
+        self.factory = factory
+        self.future = future
+
+class OutboundScheduler:
+    """Paces our own REST calls (panel edits/sends, progress edits) per route.
+
+    Calls wait for the route's token bucket and for any Discord-reported
+    bucket/global limit, and are retried with jittered backoff on 429s and
+    5xx. Calls sharing a coalesce key run one at a time, in order; a queued
+    one is replaced by a newer call with the same key and every caller gets
+    the one result.
+    """
+
+    def __init__(self, limits: RateLimits):
+        self.limits = limits
+        self.pacers = {}   # route -> TokenBucket
+        self._pruned = time.monotonic()
+        self.pending = {}  # coalesce key -> queued _Job
+        self.running = {}  # coalesce key -> task of the newest job
+        self.depth = 0
+        self.throttled = 0.0
+        self.retries = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    async def run(self, route: str, factory, key=None):
+        """Await factory() once route allows it. factory must build a fresh coroutine per call."""
+        job = self.pending.get(key) if key is not None else None
+        if job is not None:
+            job.factory = factory  # newest content wins
+            self.coalesced += 1
+        else:
+            job = _Job(factory, asyncio.get_running_loop().create_future())
+            prev = None
+            if key is not None:
+                self.pending[key] = job
+                prev = self.running.get(key)
+            task = asyncio.create_task(self._drive(route, key, job, prev))
+            if key is not None:
+                self.running[key] = task
+        return await asyncio.shield(job.future)
+
+    def reset(self):
+        # queued jobs belong to an event loop that is gone after a restart
+        self.pending.clear()
+        self.running.clear()
+        self.depth = 0
+
+    def submit(self, route: str, factory, key=None):
+        """run() without waiting for it; failures are counted, not raised."""
+        task = asyncio.create_task(self.run(route, factory, key))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    def _prune(self, now: float):
+        # a pacer left alone for a whole period is full again, like a new one
+        if now - self._pruned < RATE_IDLE:
+            return
+        self._pruned = now
+        self.pacers = {route: p for route, p in self.pacers.items() if now - p.updated < p.per}
+
+    async def _wait(self, route: str):
+        self._prune(time.monotonic())
+        pacer = self.pacers.get(route)
+        if pacer is None:
+            pacer = self.pacers[route] = TokenBucket()
+        wait = max(pacer.take(), self.limits.delay(route))
+        if wait:
+            self.throttled += wait
+            await asyncio.sleep(wait)
+
+    async def _drive(self, route: str, key, job: _Job, prev=None):
+        self.depth += 1
+        try:
+            if prev is not None:
+                await prev  # never raises, see below
+            error = None
+            for attempt in range(RATE_ATTEMPTS):
+                await self._wait(route)
+                if key is not None and self.pending.get(key) is job:
+                    del self.pending[key]  # from here on a new call queues behind us
+                try:
+                    result = await job.factory()
+                except discord.RateLimited as e:
+                    error, wait = e, e.retry_after
+                except discord.HTTPException as e:
+                    if e.status != 429 and e.status < 500:
+                        error = e
+                        break
+                    error = e
+                    wait = _retry_after(e.response.headers) if e.response is not None else 0.0
+                else:
+                    if not job.future.done():
+                        job.future.set_result(result)
+                    return
+                self.retries += 1
+                wait = jittered(max(wait, min(RATE_BACKOFF_BASE * 2 ** attempt, RATE_BACKOFF_MAX)))
+                self.throttled += wait
+                await asyncio.sleep(wait)
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(error)
+        except Exception as e:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            self.depth -= 1
+            if key is not None:
+                if self.pending.get(key) is job:
+                    del self.pending[key]
+                if self.running.get(key) is asyncio.current_task():
+                    del self.running[key]
+
+rate_limits = RateLimits()
+outbound = OutboundScheduler(rate_limits)
+metrics.gauge("bot_outbound_queue_depth", "Outbound calls waiting or in flight", lambda: outbound.depth)
+metrics.gauge("bot_outbound_throttle_seconds_total", "Time outbound calls spent waiting on rate limits",
+              lambda: outbound.throttled, kind="counter")
+metrics.gauge("bot_outbound_retries_total", "Outbound calls retried after 429/5xx", lambda: outbound.retries, kind="counter")
+metrics.gauge("bot_outbound_coalesced_total", "Queued outbound calls replaced by a newer one",
+              lambda: outbound.coalesced, kind="counter")
+metrics.gauge("bot_outbound_failed_total", "Outbound calls given up on", lambda: outbound.failed, kind="counter")
+metrics.gauge("bot_discord_429_total", "429 responses seen from Discord", lambda: rate_limits.hits_429, kind="counter")
+
+async def _trace_headers(session, ctx, params):
+    rate_limits.update(params.method, params.url.path, params.response.status, params.response.headers)
+
+http_trace.on_request_end.append(_trace_headers)
 
 # =========================
 # Discord Bot
 # =========================
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+bot = commands.Bot(
+    command_prefix="!", intents=intents, http_trace=http_trace, max_ratelimit_timeout=RATE_WAIT_MAX
+)
 
-cache_name = {}  # normalized_name -> (name, code, user_id)
-cache_code = {}  # normalized_code -> (name, code, user_id)
+caches = {}  # guild_id -> GuildCache, only for guilds used lately (see get_cache)
+data_generation = 0  # bumped on every cache change (see bump_generation); replies cached at an older one are stale
 
 # =========================
 # Helpers
@@ -55,152 +454,1689 @@ def normalize_name(name: str) -> str:
 def normalize_code(code: str) -> str:
     return str(code).strip().lower().replace(" ", "")
 
+SORT_RUN = 1 << 14  # items per C-level sort in sorted_in_steps
+
+def sorted_in_steps(items, key):
+    """sorted(items, key=key) for a thread working next to the event loop.
+
+    A thread inside one long C call (a single sort of 100k+ keys) never
+    hands the GIL back, which stalls the loop for as long. Short runs are
+    sorted in C and merged by heapq.merge, which is Python code the
+    interpreter can switch out of.
+    """
+    runs = [sorted(items[i:i + SORT_RUN], key=key) for i in range(0, len(items), SORT_RUN)]
+    return list(heapq.merge(*runs, key=key))
+
 def is_valid_id(user_id: str) -> bool:
     user_id = str(user_id).strip()
-    return user_id.isdigit() and len(user_id) >= 15
+    # Discord snowflakes: ASCII digits, no leading zero, fit in 64 bits
+    return (
+        user_id.isascii() and user_id.isdigit() and len(user_id) >= 15
+        and user_id[0] != "0" and int(user_id) < 2 ** 64
+    )
 
 # =========================
-# DB init + migration
+# Record store
 # =========================
-def table_exists(conn, name: str) -> bool:
-    c = conn.cursor()
-    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (name,))
-    return c.fetchone() is not None
+_EMPTY, _TOMB = -1, -2  # hash slot markers
+KEY_MAX_BYTES = 0xFFFF  # longest name or code in UTF-8; RecordStore keeps their lengths in array('H')
 
-def get_table_columns(conn, table: str):
-    c = conn.cursor()
-    c.execute(f"PRAGMA table_info({table})")
-    return [row[1] for row in c.fetchall()]
+def key_too_long(key: str) -> bool:
+    return len(key.encode("utf-8")) > KEY_MAX_BYTES
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+class RecordStore:
+    """Compact in-memory copy of the users table.
 
-    if not table_exists(conn, "users"):
-        c.execute("""
-            CREATE TABLE users (
-                name TEXT PRIMARY KEY,
-                code TEXT UNIQUE,
-                user_id TEXT NOT NULL
-            )
-        """)
-        conn.commit()
-        conn.close()
-        return
+    Names and codes are packed as UTF-8 into one bytearray and addressed by
+    per-row offset/length columns; user IDs are 64-bit ints in an
+    array('Q'). The two lookup maps are open-addressing hash tables of row
+    indices (array('i')), so no per-record str, int or tuple objects are
+    kept. A third table maps each user ID to the head of a chain of its rows
+    (one person can hold several names). Records are built as
+    (name, code, user_id) tuples only when read, so callers still see the
+    old shape.
+    """
 
-    cols = get_table_columns(conn, "users")
-    if "code" not in cols:
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS users_new (
-                name TEXT PRIMARY KEY,
-                code TEXT UNIQUE,
-                user_id TEXT NOT NULL
-            )
-        """)
-        c.execute("SELECT name, user_id FROM users")
-        rows = c.fetchall()
-        for n, uid in rows:
-            nn = normalize_name(n)
-            c.execute(
-                "INSERT OR REPLACE INTO users_new (name, code, user_id) VALUES (?, NULL, ?)",
-                (nn, str(uid))
-            )
-        c.execute("DROP TABLE users")
-        c.execute("ALTER TABLE users_new RENAME TO users")
-        conn.commit()
+    def __init__(self):
+        self._blob = bytearray()
+        self._name_at = array("I")
+        self._name_len = array("H")
+        self._code_at = array("I")
+        self._code_len = array("H")  # 0 = no code
+        self._live = bytearray()
+        self.uids = array("Q")
+        self._names = array("i", [_EMPTY] * 8)  # name hash slots -> row
+        self._codes = array("i", [_EMPTY] * 8)  # code hash slots -> row
+        self._by_uid = array("i", [_EMPTY] * 8)  # uid hash slots -> first row with that uid
+        self._uid_next = array("i")  # row -> next row with the same uid
+        self._used = [0, 0, 0]  # occupied + tombstone slots per table
+        self.uid_count = 0  # distinct user IDs
+        self._free = array("i")  # dropped rows, reused by put
+        self._dead = 0  # blob bytes no live row points at
+        self.count = 0
+        self.code_count = 0
+
+    def __len__(self):
+        return self.count
+
+    # ---- columns
+    def name(self, row: int) -> str:
+        at = self._name_at[row]
+        return self._blob[at:at + self._name_len[row]].decode("utf-8")
+
+    def code(self, row: int):
+        n = self._code_len[row]
+        if not n:
+            return None
+        at = self._code_at[row]
+        return self._blob[at:at + n].decode("utf-8")
+
+    def record(self, row: int):
+        return (self.name(row), self.code(row), str(self.uids[row]))
+
+    def alive(self, row) -> bool:
+        return row is not None and 0 <= row < len(self._live) and bool(self._live[row])
+
+    def rows(self):
+        return (row for row, live in enumerate(self._live) if live)
+
+    def records(self):
+        for row in self.rows():
+            yield self.record(row)
+
+    def order_key(self, row: int):
+        # same order as "ORDER BY code IS NULL, code, name"
+        code = self.code(row)
+        return (code is None, code or "", self.name(row))
+
+    # ---- lookup maps
+    def _probe(self, table: int, key: str):
+        """(slot holding key or None, first reusable slot) in a hash table."""
+        slots = self._names if table == 0 else self._codes
+        read = self.name if table == 0 else self.code
+        mask = len(slots) - 1
+        i = hash(key) & mask
+        reuse = None
+        while True:
+            row = slots[i]
+            if row == _EMPTY:
+                return None, i if reuse is None else reuse
+            if row == _TOMB:
+                if reuse is None:
+                    reuse = i
+            elif read(row) == key:
+                return i, i
+            i = (i + 1) & mask
+
+    def _lookup(self, table: int, key: str):
+        if not key:
+            return None
+        slot, _ = self._probe(table, key)
+        if slot is None:
+            return None
+        return (self._names if table == 0 else self._codes)[slot]
+
+    def _link(self, table: int, key: str, row: int):
+        slots = self._names if table == 0 else self._codes
+        if (self._used[table] + 1) * 3 > len(slots) * 2:
+            self._rehash(table)
+            slots = self._names if table == 0 else self._codes
+        slot, free = self._probe(table, key)
+        if slot is None:
+            if slots[free] == _EMPTY:
+                self._used[table] += 1
+            slot = free
+        slots[slot] = row
+
+    def _unlink(self, table: int, key: str, row: int):
+        slot, _ = self._probe(table, key)
+        slots = self._names if table == 0 else self._codes
+        if slot is not None and slots[slot] == row:
+            slots[slot] = _TOMB
+
+    def _rehash(self, table: int):
+        live = self.count if table == 0 else self.code_count
+        size = 8
+        while size < (live + 1) * 3:  # back to at most 1/3 full
+            size *= 2
+        slots = array("i", [_EMPTY]) * size
+        read = self.name if table == 0 else self.code
+        mask = size - 1
+        for row in self.rows():
+            key = read(row)
+            if not key:
+                continue
+            i = hash(key) & mask
+            while slots[i] != _EMPTY:
+                i = (i + 1) & mask
+            slots[i] = row
+        if table == 0:
+            self._names = slots
+        else:
+            self._codes = slots
+        self._used[table] = live
+
+    # ---- user ID chains
+    @staticmethod
+    def _uid_slot(uid: int, mask: int) -> int:
+        # snowflake low bits are mostly a small counter; fold the timestamp in
+        return (uid ^ (uid >> 22)) & mask
+
+    def _uid_probe(self, uid: int):
+        slots = self._by_uid
+        mask = len(slots) - 1
+        i = self._uid_slot(uid, mask)
+        reuse = None
+        while True:
+            row = slots[i]
+            if row == _EMPTY:
+                return None, i if reuse is None else reuse
+            if row == _TOMB:
+                if reuse is None:
+                    reuse = i
+            elif self.uids[row] == uid:
+                return i, i
+            i = (i + 1) & mask
+
+    def _uid_link(self, row: int):
+        if (self._used[2] + 1) * 3 > len(self._by_uid) * 2:
+            self._uid_rehash(skip=row)
+        slot, free = self._uid_probe(self.uids[row])
+        if slot is None:
+            if self._by_uid[free] == _EMPTY:
+                self._used[2] += 1
+            self.uid_count += 1
+            self._uid_next[row] = _EMPTY
+            self._by_uid[free] = row
+        else:
+            self._uid_next[row] = self._by_uid[slot]
+            self._by_uid[slot] = row
 
-    conn.close()
+    def _uid_unlink(self, row: int):
+        slot, _ = self._uid_probe(self.uids[row])
+        if slot is None:
+            return
+        head = self._by_uid[slot]
+        if head == row:
+            nxt = self._uid_next[row]
+            if nxt == _EMPTY:
+                self._by_uid[slot] = _TOMB
+                self.uid_count -= 1
+            else:
+                self._by_uid[slot] = nxt
+            return
+        while head != _EMPTY:
+            nxt = self._uid_next[head]
+            if nxt == row:
+                self._uid_next[head] = self._uid_next[row]
+                return
+            head = nxt
+
+    def _uid_rehash(self, skip: int = None):
+        size = 8
+        while size < (self.count + 1) * 3 // 2:  # rows >= distinct uids, so no re-grow below
+            size *= 2
+        self._by_uid = array("i", [_EMPTY]) * size
+        self._used[2] = self.uid_count = 0
+        for row in self.rows():
+            if row != skip:
+                self._uid_link(row)
+
+    def rows_of_uid(self, uid: int):
+        slot, _ = self._uid_probe(uid)
+        row = _EMPTY if slot is None else self._by_uid[slot]
+        while row != _EMPTY:
+            yield row
+            row = self._uid_next[row]
+
+    def row_of_name(self, name: str):
+        return self._lookup(0, name)
+
+    def row_of_code(self, code: str):
+        return self._lookup(1, code)
+
+    def get(self, kind: str, key: str):
+        row = self._lookup(0 if kind == "n" else 1, key)
+        return None if row is None else self.record(row)
+
+    def find(self, key: str):
+        """Record whose name or (else) code matches key."""
+        row = self.row_of_name(normalize_name(key))
+        if row is None:
+            row = self.row_of_code(normalize_code(key))
+        return None if row is None else self.record(row)
+
+    # ---- writes
+    @staticmethod
+    def _check(name: str, code, user_id):
+        """(name bytes, code bytes, uid) of a record, or ValueError before any column changes."""
+        name_data = name.encode("utf-8")
+        code_data = code.encode("utf-8") if code else b""
+        if max(len(name_data), len(code_data)) > KEY_MAX_BYTES:
+            raise ValueError(f"name or code over {KEY_MAX_BYTES} UTF-8 bytes: {name[:40]!r}")
+        uid = int(user_id)
+        if not 0 <= uid < 2 ** 64 or str(uid) != str(user_id):
+            # kept as a 64-bit int, so it must read back as the same text
+            raise ValueError(f"user ID the store cannot hold: {user_id!r}")
+        return name_data, code_data, uid
+
+    def _pack(self, data: bytes):
+        at = len(self._blob)
+        self._blob += data
+        return at, len(data)
+
+    def put(self, name: str, code, user_id) -> int:
+        code = code or None
+        name_data, code_data, uid = self._check(name, code, user_id)
+        name_at, name_len = self._pack(name_data)
+        code_at, code_len = self._pack(code_data) if code else (0, 0)
+        if self._free:
+            row = self._free.pop()
+            self._name_at[row], self._name_len[row] = name_at, name_len
+            self._code_at[row], self._code_len[row] = code_at, code_len
+            self.uids[row] = uid
+            self._live[row] = 1
+        else:
+            row = len(self._live)
+            self._name_at.append(name_at)
+            self._name_len.append(name_len)
+            self._code_at.append(code_at)
+            self._code_len.append(code_len)
+            self.uids.append(uid)
+            self._uid_next.append(_EMPTY)
+            self._live.append(1)
+        self.count += 1
+        self._link(0, name, row)
+        self._uid_link(row)
+        if code:
+            self.code_count += 1
+            self._link(1, code, row)
+        return row
+
+    def extend(self, records, bad=None):
+        """Bulk load distinct (name, code, user_id) rows, e.g. straight from the users table.
+
+        A bad record raises ValueError, the rows before it staying loaded;
+        with a bad list given, it is appended there and skipped instead.
+        """
+        try:
+            for name, code, user_id in records:
+                try:
+                    name_data, code_data, uid = self._check(name, code, user_id)
+                except ValueError:
+                    if bad is None:
+                        raise
+                    bad.append((name, code, user_id))
+                    continue
+                name_at, name_len = self._pack(name_data)
+                code_at, code_len = self._pack(code_data) if code else (0, 0)
+                self._name_at.append(name_at)
+                self._name_len.append(name_len)
+                self._code_at.append(code_at)
+                self._code_len.append(code_len)
+                self.uids.append(uid)
+                self._uid_next.append(_EMPTY)
+                self._live.append(1)
+                self.count += 1
+                if code:
+                    self.code_count += 1
+        finally:
+            self._rehash(0)
+            self._rehash(1)
+            self._uid_rehash()
+
+    def drop(self, row: int):
+        name, code = self.name(row), self.code(row)
+        self._unlink(0, name, row)
+        if code:
+            self._unlink(1, code, row)
+            self.code_count -= 1
+        self._uid_unlink(row)
+        self.count -= 1
+        self._live[row] = 0
+        self._dead += self._name_len[row] + self._code_len[row]
+        self._code_len[row] = 0
+        self.uids[row] = 0
+        self._free.append(row)
+        if self._dead > (1 << 20) and self._dead * 2 > len(self._blob):
+            self._compact()
+
+    def _compact(self):
+        # rewrite the blob with live rows only; row numbers do not change
+        blob = bytearray()
+        for row in self.rows():
+            for at_col, len_col in ((self._name_at, self._name_len), (self._code_at, self._code_len)):
+                at, n = at_col[row], len_col[row]
+                at_col[row] = len(blob)
+                blob += self._blob[at:at + n]
+        self._blob = blob
+        self._dead = 0
+
+    # ---- snapshots
+    _ROW_COLUMNS = ("_name_at", "_name_len", "_code_at", "_code_len", "uids", "_uid_next")  # one item per row
+    _SNAPSHOT_COLUMNS = (
+        "_blob", "_name_at", "_name_len", "_code_at", "_code_len", "_live", "uids", "_by_uid", "_uid_next", "_free",
+    )
+
+    def snapshot_state(self):
+        """(columns, scalars) copied for a snapshot file.
+
+        The name/code tables are left out: they hold str hashes, which
+        change from process to process, so from_snapshot rebuilds them.
+        """
+        columns = {}
+        for name in self._SNAPSHOT_COLUMNS:
+            col = getattr(self, name)
+            columns[name] = (getattr(col, "typecode", ""), bytes(col))
+        scalars = {
+            "dead": self._dead, "count": self.count,
+            "code_count": self.code_count, "uid_count": self.uid_count, "uid_used": self._used[2],
+        }
+        return columns, scalars
+
+    @classmethod
+    def from_snapshot(cls, columns, scalars):
+        """Store from snapshot_state() output; columns map name -> (typecode, buffer)."""
+        self = cls()
+        for name, (typecode, data) in columns.items():
+            if name not in cls._SNAPSHOT_COLUMNS:
+                continue
+            if typecode:
+                col = array(typecode)
+                col.frombytes(data)
+            else:
+                col = bytearray(data)
+            setattr(self, name, col)
+        self._dead = scalars["dead"]
+        self.count = scalars["count"]
+        self.code_count = scalars["code_count"]
+        self.uid_count = scalars["uid_count"]
+        self._used[2] = scalars["uid_used"]
+        rows = len(self._live)
+        if any(len(getattr(self, name)) != rows for name in self._ROW_COLUMNS) or self._live.count(1) != self.count:
+            raise ValueError("snapshot columns disagree with each other or with the counts")
+        self._rehash(0)
+        self._rehash(1)
+        return self
 
 # =========================
-# Cache
+# Search index (prefix + fuzzy)
 # =========================
-def load_cache():
-    global cache_name, cache_code
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT name, code, user_id FROM users")
-    rows = c.fetchall()
-    conn.close()
+SEARCH_LIMIT = 10          # max prefix/fuzzy results per query
+SEARCH_PREFIX_SCAN = 100   # sorted entries looked at per prefix query
+SEARCH_FUZZY_SCAN = 200    # candidate records checked per fuzzy query
+SEARCH_GRAM_SCAN = 1000    # trigram postings read per fuzzy query word
+SEARCH_EXPAND_MAX = 20     # vocabulary words edit-checked per query word
+SEARCH_BLOCK = 512         # sorted index entries per block (a block splits at twice this)
+AUTOCOMPLETE_LIMIT = 25    # Discord's cap on autocomplete choices
+_OFF_BITS = 16             # index entry = ref << _OFF_BITS | byte offset of a word start
+_OFF_MASK = (1 << _OFF_BITS) - 1
+
+_AR_FOLD = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ة": "ه", "ى": "ي", "ؤ": "و", "ئ": "ي",
+    "ـ": None,  # tatweel
+})
+_AR_MARKS = re.compile(r"[\u064B-\u065F\u0670]")  # tashkeel
+
+def fold_key(text: str) -> str:
+    # احمد / أحمد / أحْمد -> احمد
+    s = _AR_MARKS.sub("", normalize_name(text)).translate(_AR_FOLD)
+    return " ".join(s.split())
+
+def _trigrams(folded: str):
+    s = f" {folded} "
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+def _typo_words(folded: str):
+    # words with digits (code numbers, counters) stay out of the fuzzy vocabulary:
+    # one edit away from a number is somebody else's number
+    return {w for w in folded.split() if not any(ch.isdigit() for ch in w)}
+
+def bounded_distance(a: str, b: str, k: int) -> int:
+    """Levenshtein distance between a and b, or k + 1 once it is known to exceed k."""
+    if abs(len(a) - len(b)) > k:
+        return k + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        if min(cur) > k:
+            return k + 1
+        prev = cur
+    return prev[-1] if prev[-1] <= k else k + 1
+
+class SearchIndex:
+    """Prefix + fuzzy index over the names and codes of a RecordStore.
+
+    A key is addressed by ref = row * 2 (+ 1 for the row's code). Folded
+    keys are packed as UTF-8 into one bytearray, like the store's columns,
+    and UTF-8 bytes sort like the str they encode. Prefix queries bisect a
+    sorted run of entries (ref << 16 | byte offset), one per key and per
+    later word start in it; the run is cut into blocks of array('Q') so an
+    insert or delete only shifts one small block. The keys holding a word
+    are the entries from word to word + "!" (the key itself, or a word
+    start followed by a space). Fuzzy queries expand each query word to
+    vocabulary words within a small edit distance via a trigram index of
+    word ids, then walk the keys of the rarest one.
+    """
+
+    def __init__(self, store: RecordStore):
+        self.store = store
+        self._blob = bytearray()
+        self._at = array("I")   # ref -> offset of its folded key in _blob
+        self._len = array("I")  # ref -> byte length of its folded key, 0 = not indexed
+        self._dead = 0          # blob bytes no indexed key points at
+        self._blocks = []       # sorted runs of entries
+        self._heads = []        # sort key of each block's first entry
+        self.words = {}         # folded word -> word id
+        self._word_text = []    # word id -> word (None once free)
+        self._word_keys = array("I")  # word id -> indexed keys holding the word
+        self._free_words = []
+        self.grams = {}         # trigram -> array of word ids
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    # ---- entries
+    def _text(self, ref: int):
+        at = self._at[ref]
+        return self._blob[at:at + self._len[ref]]
+
+    def _key(self, entry: int):
+        ref = entry >> _OFF_BITS
+        at = self._at[ref]
+        return self._blob[at + (entry & _OFF_MASK):at + self._len[ref]], entry
+
+    def _head(self, entry: int):
+        text, entry = self._key(entry)
+        return bytes(text), entry
+
+    @staticmethod
+    def _entries(ref: int, data):
+        base = ref << _OFF_BITS
+        out = [base]
+        i = data.find(b" ")
+        while 0 <= i < _OFF_MASK:
+            out.append(base | (i + 1))
+            i = data.find(b" ", i + 1)
+        return out
+
+    def _seek(self, key):
+        """(block, index) of the first entry at or after key."""
+        if not self._blocks:
+            return 0, 0
+        b = max(0, bisect_right(self._heads, key) - 1)
+        return b, bisect_left(self._blocks[b], key, key=self._key)
+
+    def _scan(self, key):
+        b, i = self._seek(key)
+        blocks = self._blocks
+        while b < len(blocks):
+            block = blocks[b]
+            while i < len(block):
+                yield block[i]
+                i += 1
+            b, i = b + 1, 0
+
+    def _insert(self, entry: int):
+        if not self._blocks:
+            self._blocks.append(array("Q", [entry]))
+            self._heads.append(self._head(entry))
+            return
+        b, i = self._seek(self._key(entry))
+        block = self._blocks[b]
+        block.insert(i, entry)
+        if i == 0:
+            self._heads[b] = self._head(entry)
+        if len(block) > 2 * SEARCH_BLOCK:
+            self._blocks.insert(b + 1, block[SEARCH_BLOCK:])
+            self._heads.insert(b + 1, self._head(block[SEARCH_BLOCK]))
+            del block[SEARCH_BLOCK:]
+
+    def _delete(self, entry: int):
+        b, i = self._seek(self._key(entry))
+        if not self._blocks:
+            return
+        block = self._blocks[b]
+        if i < len(block) and block[i] == entry:
+            del block[i]
+            if not block:
+                del self._blocks[b]
+                del self._heads[b]
+            elif i == 0:
+                self._heads[b] = self._head(block[0])
+
+    # ---- vocabulary (fuzzy)
+    def _add_word(self, w: str):
+        wid = self.words.get(w)
+        if wid is None:
+            if self._free_words:
+                wid = self._free_words.pop()
+                self._word_text[wid] = w
+            else:
+                wid = len(self._word_text)
+                self._word_text.append(w)
+                self._word_keys.append(0)
+            self.words[w] = wid
+            for g in _trigrams(w):
+                ids = self.grams.get(g)
+                if ids is None:
+                    ids = self.grams[g] = array("I")
+                ids.append(wid)
+        self._word_keys[wid] += 1
+
+    def _drop_word(self, w: str):
+        wid = self.words.get(w)
+        if wid is None:
+            return
+        self._word_keys[wid] -= 1
+        if self._word_keys[wid]:
+            return
+        del self.words[w]
+        self._word_text[wid] = None
+        self._free_words.append(wid)
+        for g in _trigrams(w):
+            ids = self.grams.get(g)
+            if ids is not None and wid in ids:
+                ids.remove(wid)
+                if not ids:
+                    del self.grams[g]
+
+    # ---- writes
+    @staticmethod
+    def _fold_ref(ref: int, key: str):
+        folded = fold_key(key)
+        # codes compare without separators: "h-07" / "h 07" / "h07"
+        return folded.replace(" ", "") if ref & 1 else folded
+
+    def _index(self, ref: int, key: str):
+        """Pack the key's folded text and count its words; returns its entries."""
+        if ref < len(self._len) and self._len[ref]:
+            return []
+        folded = self._fold_ref(ref, key)
+        if not folded:
+            return []
+        data = folded.encode("utf-8")
+        if ref >= len(self._len):
+            grow = bytes((ref + 1 - len(self._len)) * self._len.itemsize)
+            self._at.frombytes(grow)
+            self._len.frombytes(grow)
+        self._at[ref] = len(self._blob)
+        self._len[ref] = len(data)
+        self._blob += data
+        self.count += 1
+        for w in _typo_words(folded):
+            self._add_word(w)
+        return self._entries(ref, data)
+
+    def _row_refs(self, row: int):
+        store = self.store
+        out = [(row * 2, store.name(row))]
+        code = store.code(row)
+        if code:
+            out.append((row * 2 + 1, code))
+        return out
+
+    def add(self, row: int):
+        for ref, key in self._row_refs(row):
+            for entry in self._index(ref, key):
+                self._insert(entry)
+
+    def add_many(self, rows):
+        """Index many rows with one sort of every entry."""
+        entries = [e for block in self._blocks for e in block]
+        for row in rows:
+            for ref, key in self._row_refs(row):
+                entries.extend(self._index(ref, key))
+        entries = sorted_in_steps(entries, self._key)
+        self._blocks = [array("Q", entries[i:i + SEARCH_BLOCK]) for i in range(0, len(entries), SEARCH_BLOCK)]
+        self._heads = [self._head(block[0]) for block in self._blocks]
+
+    def remove(self, row: int):
+        for ref in (row * 2, row * 2 + 1):
+            if ref >= len(self._len) or not self._len[ref]:
+                continue
+            data = self._text(ref)
+            for entry in self._entries(ref, data):
+                self._delete(entry)
+            for w in _typo_words(data.decode("utf-8")):
+                self._drop_word(w)
+            self._dead += self._len[ref]
+            self._len[ref] = 0
+            self.count -= 1
+        if self._dead > (1 << 20) and self._dead * 2 > len(self._blob):
+            self._compact()
+
+    def _compact(self):
+        # rewrite the blob with indexed keys only; entries do not change
+        blob = bytearray()
+        for ref, n in enumerate(self._len):
+            if n:
+                at = self._at[ref]
+                self._at[ref] = len(blob)
+                blob += self._blob[at:at + n]
+        self._blob = blob
+        self._dead = 0
+
+    # ---- queries
+    def _ref(self, ref: int):
+        row = ref >> 1
+        return ("c", self.store.code(row)) if ref & 1 else ("n", self.store.name(row))
+
+    def search(self, query: str, limit: int = SEARCH_LIMIT, fuzzy: bool = True):
+        """Ranked (kind, key) refs: exact (folded) > key prefix > word prefix > fuzzy."""
+        q = fold_key(query)
+        if not q:
+            return []
+
+        best = {}  # ref -> best score seen
+        compact = q.replace(" ", "")
+        self._prefix(q, best)
+        if compact != q:
+            self._prefix(compact, best)
+        if fuzzy and len(best) < limit:
+            self._fuzzy(q.split(), best)
+            if compact != q:
+                self._fuzzy([compact], best)
+
+        ranked = heapq.nsmallest(limit, ((score, ref) for ref, score in best.items()))
+        return [self._ref(ref) for _, ref in ranked]
+
+    def _prefix(self, q: str, best):
+        qb = q.encode("utf-8")
+        blob, at_of, len_of = self._blob, self._at, self._len
+        b, i = self._seek((qb,))
+        left = SEARCH_PREFIX_SCAN
+        for block in self._blocks[b:]:
+            for entry in block[i:i + left]:
+                ref, off = entry >> _OFF_BITS, entry & _OFF_MASK
+                at, size = at_of[ref], len_of[ref]
+                if not blob.startswith(qb, at + off, at + size):
+                    return
+                # shorter keys first; UTF-8 length orders them like str length within a script
+                score = (0 if size == len(qb) else (1 if not off else 2), 0, size)
+                old = best.get(ref)
+                if old is None or score < old:
+                    best[ref] = score
+            left -= len(block) - i
+            if left <= 0:
+                return
+            i = 0
+
+    def _expand(self, token: str):
+        """Vocabulary words within a small edit distance of token -> distance."""
+        out = {}
+        if token in self.words:
+            out[token] = 0
+        k = 0 if len(token) <= 3 else (1 if len(token) <= 7 else 2)
+        if not k:
+            return out
+
+        grams = _trigrams(token)
+        # q-gram lemma: k edits destroy at most 3k of the token's trigrams
+        need = len(grams) - 3 * k
+        if need < 1:
+            return out
+        # count the rarest trigrams first; the ones left unread could each add one more
+        postings = sorted((self.grams.get(g, ()) for g in grams), key=len)
+        counts = {}
+        budget = SEARCH_GRAM_SCAN
+        read = 0
+        for ids in postings:
+            if len(ids) > budget:
+                break
+            budget -= len(ids)
+            read += 1
+            for wid in ids:
+                counts[wid] = counts.get(wid, 0) + 1
+        need -= len(postings) - read
+        text = self._word_text
+        candidates = [wid for wid, n in counts.items() if n >= need and text[wid] not in out]
+        if len(candidates) > SEARCH_EXPAND_MAX:
+            candidates = heapq.nlargest(SEARCH_EXPAND_MAX, candidates, key=counts.__getitem__)
+        for wid in candidates:
+            w = text[wid]
+            d = bounded_distance(token, w, k)
+            if d <= k:
+                out[w] = d
+        return out
+
+    def _word_entries(self, w: str):
+        """Entries of the keys holding word w."""
+        wb = w.encode("utf-8")
+        blob = self._blob
+        for entry in self._scan((wb,)):
+            ref, off = entry >> _OFF_BITS, entry & _OFF_MASK
+            at, size = self._at[ref] + off, self._len[ref] - off
+            if not blob.startswith(wb, at, at + size):
+                return
+            if size == len(wb) or blob[at + len(wb)] == 0x20:
+                yield entry
+            elif blob[at + len(wb)] > 0x20:
+                return
+
+    def _fuzzy(self, tokens, best):
+        expansions = [self._expand(t) for t in tokens]
+        if not expansions or not all(expansions):
+            return
 
-    cache_name = {}
-    cache_code = {}
+        # walk the keys of the rarest query word, check the others against them
+        keys = self._word_keys
+        order = sorted(
+            range(len(tokens)),
+            key=lambda i: sum(keys[self.words[w]] for w in expansions[i])
+        )
+        first, rest = expansions[order[0]], [expansions[i] for i in order[1:]]
+        scanned = 0
+        for w, d0 in sorted(first.items(), key=lambda kv: kv[1]):
+            for entry in self._word_entries(w):
+                scanned += 1
+                if scanned > SEARCH_FUZZY_SCAN:
+                    return
+                ref = entry >> _OFF_BITS
+                full = self._text(ref).decode("utf-8")
+                have = set(full.split())
+                total = d0
+                for exp in rest:
+                    ds = [d for w2, d in exp.items() if w2 in have]
+                    if not ds:
+                        break
+                    total += min(ds)
+                else:
+                    score = (3, total, len(full))
+                    old = best.get(ref)
+                    if old is None or score < old:
+                        best[ref] = score
 
-    for name, code, user_id in rows:
-        nn = normalize_name(name)
-        cc = normalize_code(code) if code is not None else None
-        rec = (nn, cc, str(user_id))
-        cache_name[nn] = rec
-        if cc:
-            cache_code[cc] = rec
+# =========================
+# DB access layer
+# =========================
+# كل شغل SQLite يصير خارج الـ event loop:
+# - الكتابة: thread واحد (writer) يسحب المهام من queue بالترتيب
+# - القراءة: pool صغير من اتصالات ثابتة (WAL يسمح بالقراءة أثناء الكتابة)
+DB_READERS = int(os.getenv("DB_READERS", "3") or "3")
+SQL_CHUNK = 500  # max bound parameters per IN (...) statement
+CACHE_RESORT_MIN = 1000  # upsert batches this big (or 1/8 of the cache) rebuild the cache instead of patching it
+CACHE_PATCH_CHUNK = 5  # rows patched into a cache between looks at the clock
+CACHE_PATCH_SLICE = 0.005  # seconds a write may patch a cache before it lets the loop run
+
+_write_queue = queue.Queue()
+_writer_thread = None
+_read_pool = None
+_read_local = local()
+
+def db_connect(readonly: bool = False):
+    conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    if readonly:
+        conn.execute("PRAGMA query_only=1")
+    return conn
+
+def _resolve(fut, result, error):
+    if fut.cancelled():
+        return
+    if error is not None:
+        fut.set_exception(error)
+    else:
+        fut.set_result(result)
+
+def _writer_loop():
+    conn = db_connect()
+    while True:
+        job = _write_queue.get()
+        if job is None:
+            break
+        fn, args, fut, loop = job
+        result, error = None, None
+        try:
+            result = fn(conn, *args)
+        except Exception as e:
+            conn.rollback()
+            error = e
+        loop.call_soon_threadsafe(_resolve, fut, result, error)
+    conn.close()
 
-    print(f"✅ Cache loaded: {len(cache_name)} names, {len(cache_code)} codes")
+def _run_read(fn, args):
+    conn = getattr(_read_local, "conn", None)
+    if conn is None:
+        conn = db_connect(readonly=True)
+        _read_local.conn = conn
+    return fn(conn, *args)
+
+def start_db():
+    global _writer_thread, _read_pool
+    if _writer_thread is None or not _writer_thread.is_alive():
+        _writer_thread = Thread(target=_writer_loop, name="db-writer", daemon=True)
+        _writer_thread.start()
+    if _read_pool is None:
+        _read_pool = ThreadPoolExecutor(max_workers=DB_READERS, thread_name_prefix="db-reader")
+
+def stop_db():
+    global _writer_thread, _read_pool
+    if _writer_thread is not None:
+        _write_queue.put(None)
+        _writer_thread.join()
+        _writer_thread = None
+    if _read_pool is not None:
+        _read_pool.shutdown(wait=True)
+        _read_pool = None
+
+async def db_write(fn, *args):
+    """Run fn(conn, *args) on the writer thread and await its result."""
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    t0 = time.perf_counter()
+    _write_queue.put((fn, args, fut, loop))
+    try:
+        return await fut
+    finally:
+        _add_stat("db", time.perf_counter() - t0)
+
+async def db_read(fn, *args):
+    """Run fn(conn, *args) on a pooled read connection and await its result."""
+    loop = asyncio.get_running_loop()
+    t0 = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_read_pool, _run_read, fn, args)
+    finally:
+        _add_stat("db", time.perf_counter() - t0)
 
 # =========================
-# Operations
+# DB init + migrations
 # =========================
-def upsert_user(name: str, code: str, user_id: str):
-    nn = normalize_name(name)
-    cc = normalize_code(code)
+# Keys are stored already normalized (normalize_name / normalize_code, empty code -> NULL),
+# so reads use them as-is. Each migration runs as set-based SQL in one transaction and
+# bumps PRAGMA user_version; never edit a shipped step, append a new one.
+USERS_SCHEMA = """
+    CREATE TABLE {table} (
+        name TEXT PRIMARY KEY,
+        code TEXT UNIQUE,
+        user_id TEXT NOT NULL
+    )
+"""
+
+# from v5: keys are unique per guild, and WITHOUT ROWID clusters each guild's rows
+# in one primary-key range, so loading or exporting a guild never reads the others
+GUILD_USERS_SCHEMA = """
+    CREATE TABLE {table} (
+        guild_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        code TEXT,
+        user_id TEXT NOT NULL,
+        PRIMARY KEY (guild_id, name),
+        UNIQUE (guild_id, code)
+    ) WITHOUT ROWID
+"""
 
-    conn = sqlite3.connect(DB_PATH)
+def table_exists(conn, name: str) -> bool:
     c = conn.cursor()
-    c.execute(
-        "INSERT OR REPLACE INTO users (name, code, user_id) VALUES (?, ?, ?)",
-        (nn, cc, str(user_id))
-    )
-    conn.commit()
-    conn.close()
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (name,))
+    return c.fetchone() is not None
+
+def get_table_columns(conn, table: str):
+    c = conn.cursor()
+    c.execute(f"PRAGMA table_info({table})")
+    return [row[1] for row in c.fetchall()]
 
-    rec = (nn, cc, str(user_id))
-    cache_name[nn] = rec
-    cache_code[cc] = rec
-    return rec
+def _sql_code_key(code):
+    if code is None:
+        return None
+    return normalize_code(code) or None
 
-def find_row_by_key(key: str):
-    nn = normalize_name(key)
-    cc = normalize_code(key)
+def _migrate_users_table(conn):
+    # v1: users(name, code, user_id); the first versions had no code column
+    if not table_exists(conn, "users"):
+        conn.execute(USERS_SCHEMA.format(table="users"))
+        return
+    if "code" not in get_table_columns(conn, "users"):
+        conn.execute("ALTER TABLE users ADD COLUMN code TEXT")
+
+def _migrate_normalized_keys(conn):
+    # v2: normalized keys, a UNIQUE code, and indexes for user_id and the list/export order
+    dirty = conn.execute("""
+        SELECT EXISTS(
+            SELECT 1 FROM users
+            WHERE name IS NOT norm_name(name) OR code IS NOT code_key(code)
+               OR typeof(user_id) != 'text'
+        )
+    """).fetchone()[0]
+    unique_code = any(
+        unique and [r[2] for r in conn.execute(f'PRAGMA index_info("{index}")')] == ["code"]
+        for _, index, unique, *_ in conn.execute("PRAGMA index_list(users)").fetchall()
+    )
+    if dirty or not unique_code:
+        # one copy pass; on key collisions the later row wins, like INSERT OR REPLACE
+        conn.execute("DROP TABLE IF EXISTS users_new")
+        conn.execute(USERS_SCHEMA.format(table="users_new"))
+        conn.execute("""
+            INSERT OR REPLACE INTO users_new (name, code, user_id)
+            SELECT norm_name(name), code_key(code), CAST(user_id AS TEXT)
+            FROM users ORDER BY rowid
+        """)
+        conn.execute("DROP TABLE users")
+        conn.execute("ALTER TABLE users_new RENAME TO users")
+    conn.execute("CREATE INDEX IF NOT EXISTS users_user_id ON users (user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS users_order ON users (code IS NULL, code, name)")
+
+def _migrate_meta_table(conn):
+    # v3: small key/value table for process state that must survive restarts
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+def _migrate_data_rev(conn):
+    # v4: data_rev counts committed writes to users; snapshots are tagged with it
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('data_rev', '0')")
+
+def _migrate_guild_keys(conn):
+    # v5: rows are namespaced by guild; existing ones go to GUILD_ID (0 until adopted, see adopt_on_ready)
+    conn.execute("DROP TABLE IF EXISTS users_new")
+    conn.execute(GUILD_USERS_SCHEMA.format(table="users_new"))
+    conn.execute(
+        "INSERT INTO users_new (guild_id, name, code, user_id) SELECT ?, name, code, user_id FROM users",
+        (GUILD_ID,)
+    )
+    conn.execute("DROP TABLE users")
+    conn.execute("ALTER TABLE users_new RENAME TO users")
+    conn.execute("CREATE INDEX users_user_id ON users (guild_id, user_id)")
+    # user_id included so the list/export order is read from the index alone
+    conn.execute("CREATE INDEX users_order ON users (guild_id, code IS NULL, code, name, user_id)")
+    # data_rev is kept per guild from now on
+    conn.execute("UPDATE meta SET key = ? WHERE key = 'data_rev'", (f"data_rev:{GUILD_ID}",))
+
+def _migrate_guild_panels(conn):
+    # v6: where each guild's panel lives (written by /panel)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS guild_panels (
+            guild_id INTEGER PRIMARY KEY,
+            channel_id INTEGER NOT NULL,
+            message_id INTEGER
+        )
+    """)
+
+def _migrate_quarantine_ids(conn):
+    # v8: user IDs the cache cannot hold (64-bit, no leading zero; older versions let them in)
+    # move to users_quarantine, logged as deletes, instead of failing every cache load
+    conn.execute("""
+        CREATE TABLE users_quarantine (
+            guild_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            code TEXT,
+            user_id TEXT NOT NULL,
+            at INTEGER NOT NULL  -- unix seconds it was moved here
+        )
+    """)
+    at = int(time.time())
+    bad = conn.execute(
+        "SELECT guild_id, name, code, user_id FROM users WHERE NOT valid_id(user_id)"
+    ).fetchall()
+    if not bad:
+        return
+    conn.executemany(
+        "INSERT INTO users_quarantine (guild_id, name, code, user_id, at) VALUES (?, ?, ?, ?, ?)",
+        [(*row, at) for row in bad]
+    )
+    conn.executemany(
+        "INSERT INTO changes (guild_id, at, op, name) VALUES (?, ?, 'del', ?)",
+        [(guild_id, at, name) for guild_id, name, _, _ in bad]
+    )
+    conn.execute("DELETE FROM users WHERE NOT valid_id(user_id)")
+    for guild_id in {row[0] for row in bad}:
+        _bump_data_rev(conn, guild_id)
+    print(f"⚠️ {len(bad)} rows with invalid user IDs moved to users_quarantine:",
+          ", ".join(f"{uid} ({name}, guild {guild_id})" for guild_id, name, _, uid in bad[:20]))
+
+def _migrate_change_log(conn):
+    # v7: append-only log of row changes for delta exports; every write to users logs
+    # its changes in the same transaction (see JOURNAL_OPS and _adopt_legacy)
+    conn.execute("""
+        CREATE TABLE changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,  -- never reused, even after compaction
+            guild_id INTEGER NOT NULL,
+            at INTEGER NOT NULL,                    -- unix seconds
+            op TEXT NOT NULL,                       -- 'put' or 'del'
+            name TEXT NOT NULL,
+            code TEXT,
+            user_id TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX changes_guild ON changes (guild_id, seq)")
+    # the rows so far, so a log read from 0 rebuilds the whole table
+    conn.execute("""
+        INSERT INTO changes (guild_id, at, op, name, code, user_id)
+        SELECT guild_id, CAST(strftime('%s', 'now') AS INTEGER), 'put', name, code, user_id FROM users
+        ORDER BY guild_id, code IS NULL, code, name
+    """)
+
+MIGRATIONS = [
+    _migrate_users_table,       # -> 1
+    _migrate_normalized_keys,   # -> 2
+    _migrate_meta_table,        # -> 3
+    _migrate_data_rev,          # -> 4
+    _migrate_guild_keys,        # -> 5
+    _migrate_guild_panels,      # -> 6
+    _migrate_change_log,        # -> 7
+    _migrate_quarantine_ids,    # -> 8
+]
+
+def _init_db(conn):
+    conn.create_function("norm_name", 1, normalize_name, deterministic=True)
+    conn.create_function("code_key", 1, _sql_code_key, deterministic=True)
+    conn.create_function("valid_id", 1, is_valid_id, deterministic=True)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, migrate in enumerate(MIGRATIONS[version:], version + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            migrate(conn)
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        print(f"🛠️ DB migrated to v{target}")
+
+async def init_db():
+    start_db()
+    await db_write(_init_db)
+
+def _get_meta(conn, key: str):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def _set_meta(conn, key: str, value: str):
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+def _get_data_rev(conn, guild_id: int) -> int:
+    return int(_get_meta(conn, f"data_rev:{guild_id}") or 0)
+
+def _bump_data_rev(conn, guild_id: int) -> int:
+    # call inside the write transaction it describes
+    conn.execute("""
+        INSERT INTO meta (key, value) VALUES (?, '1')
+        ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+    """, (f"data_rev:{guild_id}",))
+    return _get_data_rev(conn, guild_id)
+
+async def get_meta(key: str):
+    return await db_read(_get_meta, key)
+
+async def set_meta(key: str, value: str):
+    await db_write(_set_meta, key, value)
 
-    conn = sqlite3.connect(DB_PATH)
+# =========================
+# Guild caches
+# =========================
+# Each guild gets its own store, search index and list order, loaded on first use
+# (from its snapshot when that is current) and dropped again after CACHE_IDLE, so
+# memory follows the guilds in use rather than the whole table.
+CACHE_IDLE = 30 * 60.0  # seconds without a lookup before a guild's cache is evicted
+_cache_loading = {}  # guild_id -> Task loading that guild's cache
+_latest_rev = {}  # guild_id -> newest data_rev committed by this process
+
+class GuildCache:
+    """The in-memory copy of one guild's users rows."""
+
+    def __init__(self, guild_id: int, store: RecordStore, index: SearchIndex, order: array, rev):
+        self.guild_id = guild_id
+        self.store = store  # RecordStore
+        self.search_index = index  # SearchIndex over the store's names and codes
+        self.list_order = order  # store rows sorted by (code IS NULL, code, name), for paging
+        self.rev = rev  # DB data_rev the cache mirrors (see _cache_at)
+        self.lagging = False  # misses committed rows (a big import) until load_cache replaces it
+        self.snapshot_rev = None  # data_rev of the last snapshot written or loaded
+        self.generation = 0  # data_generation of the last change
+        self.last_used = time.monotonic()
+
+def _build_cache(conn, guild_id: int):
     c = conn.cursor()
+    c.execute("BEGIN")  # the rows and data_rev must come from the same read snapshot
+    try:
+        rev = _get_data_rev(conn, guild_id)
+        c.execute("SELECT name, code, user_id FROM users WHERE guild_id = ?", (guild_id,))
+        new_store = RecordStore()
+        bad = []
+        new_store.extend(c, bad)  # keys are stored normalized
+    finally:
+        conn.rollback()
+    if bad:
+        # served from nowhere but the DB; one bad row must not keep the whole guild unloaded
+        print(f"⚠️ {len(bad)} rows of guild {guild_id} left out of its cache, e.g.:", bad[:5])
+
+    index = _build_index(new_store)
+    order = array("I", sorted_in_steps(list(new_store.rows()), new_store.order_key))
+    return new_store, index, order, rev
+
+def _install_cache(guild_id: int, new_store, index, order, rev) -> GuildCache:
+    cache = GuildCache(guild_id, new_store, index, order, rev)
+    old = caches.get(guild_id)
+    if old is not None:
+        cache.snapshot_rev = old.snapshot_rev
+    caches[guild_id] = cache
+    bump_generation(cache)
+    return cache
+
+async def load_cache(guild_id: int) -> GuildCache:
+    # everything is built on a reader thread and swapped in at once
+    while True:
+        await journal.flush(guild_id)  # queued writes would be missing from the build
+        new_store, index, order, rev = await db_read(_build_cache, guild_id)
+        if guild_id not in journal.pending and _latest_rev.get(guild_id, rev) <= rev:
+            break  # else a write landed after the read snapshot; build again
+    cache = _install_cache(guild_id, new_store, index, order, rev)
+    print(f"✅ Cache loaded for guild {guild_id}: {new_store.count} names, {new_store.code_count} codes")
+    return cache
+
+async def _load_guild(guild_id: int) -> GuildCache:
+    if not await load_snapshot(guild_id):
+        await load_cache(guild_id)
+    return caches[guild_id]
+
+def _loaded(guild_id: int, task: asyncio.Task):
+    _cache_loading.pop(guild_id, None)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"⚠️ Cache load failed for guild {guild_id}:", repr(task.exception()))
+
+def _load_task(guild_id: int) -> asyncio.Task:
+    # one load per guild however many callers are waiting for it
+    task = _cache_loading.get(guild_id)
+    if task is None:
+        task = asyncio.create_task(_load_guild(guild_id))
+        _cache_loading[guild_id] = task
+        task.add_done_callback(functools.partial(_loaded, guild_id))
+    return task
+
+async def get_cache(guild_id: int) -> GuildCache:
+    """The guild's cache, loading it first if it is not in memory."""
+    cache = caches.get(guild_id)
+    if cache is None:
+        # shielded: a caller giving up must not cancel the load for the others
+        cache = await asyncio.shield(_load_task(guild_id))
+    cache.last_used = time.monotonic()
+    return cache
+
+def _cache_written(guild_id: int, rev: int):
+    """Note a committed write; returns the guild's cache if it is loaded."""
+    _latest_rev[guild_id] = rev
+    return caches.get(guild_id)
+
+async def interaction_cache(interaction: discord.Interaction, **defer) -> GuildCache:
+    """The cache of the interaction's guild; a cold load defers first so the interaction cannot expire."""
+    if interaction.guild_id not in caches and not interaction.response.is_done():
+        await interaction.response.defer(**defer)
+    return await get_cache(interaction.guild_id)
+
+async def respond(interaction: discord.Interaction, **kwargs):
+    # answers in the followup when interaction_cache had to defer
+    if interaction.response.is_done():
+        await interaction.followup.send(**kwargs)
+    else:
+        await interaction.response.send_message(**kwargs)
+
+async def evict_idle():
+    now = time.monotonic()
+    for cache in list(caches.values()):
+        if now - cache.last_used < CACHE_IDLE or caches.get(cache.guild_id) is not cache:
+            continue
+        try:
+            await save_snapshot(cache)  # the next load starts warm
+        except OSError as e:
+            print("⚠️ Snapshot not saved:", repr(e))
+        if caches.get(cache.guild_id) is cache and now - cache.last_used >= CACHE_IDLE:
+            del caches[cache.guild_id]
+            print(f"💤 Cache evicted for idle guild {cache.guild_id}")
 
-    c.execute("SELECT name, code, user_id FROM users WHERE name = ?", (nn,))
-    row = c.fetchone()
-    if row is None:
-        c.execute("SELECT name, code, user_id FROM users WHERE code = ?", (cc,))
-        row = c.fetchone()
-
-    conn.close()
-    if not row:
+# =========================
+# Cache snapshot (warm start)
+# =========================
+# Layout: magic, u32 header length, JSON header, then each column's raw bytes
+# at a page-aligned offset, so the file can be mapped and copied column by column.
+SNAPSHOT_MAGIC = b"IDSNAP02"  # 02: the free list is a column, not a header list
+SNAPSHOT_ALIGN = 4096
+SNAPSHOT_INTERVAL = 60.0  # seconds between checks for newer caches to save
+_cache_task = None
+
+def snapshot_path(guild_id: int) -> str:
+    return f"{DB_PATH}.{guild_id}.snapshot"
+
+def _snapshot_itemsizes():
+    return {tc: array(tc).itemsize for tc in "HIiQ"}
+
+def _write_snapshot(path: str, guild_id: int, rev: int, schema: int, columns: dict, scalars: dict):
+    header = {
+        "guild_id": guild_id, "data_rev": rev, "schema": schema, "byteorder": sys.byteorder,
+        "itemsizes": _snapshot_itemsizes(), "scalars": scalars, "columns": {},
+    }
+    # offsets depend on the header size, so lay out with a generous header slot
+    layout, offset = {}, SNAPSHOT_ALIGN * 16
+    for name, (typecode, data) in columns.items():
+        layout[name] = [typecode, offset, len(data)]
+        offset += -(-len(data) // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+    header["columns"] = layout
+    raw = json.dumps(header).encode("utf-8")
+    if len(raw) + 12 > SNAPSHOT_ALIGN * 16:
+        # skip rather than write a broken file
+        print(f"⚠️ Snapshot of guild {guild_id} not saved: {len(raw)} byte header overflows its slot")
+        return False
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(SNAPSHOT_MAGIC + len(raw).to_bytes(4, "little") + raw)
+        for name, (_, data) in columns.items():
+            f.seek(layout[name][1])
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return True
+
+def _read_snapshot(conn, guild_id: int, path: str):
+    """(store, list_order, rev) from the guild's snapshot if it matches the DB, else None."""
+    conn.execute("BEGIN")  # one read snapshot for the checks below
+    try:
+        rev = _get_data_rev(conn, guild_id)
+        schema = conn.execute("PRAGMA user_version").fetchone()[0]
+        rows = conn.execute("SELECT count(*) FROM users WHERE guild_id = ?", (guild_id,)).fetchone()[0]
+    finally:
+        conn.rollback()
+    try:
+        f = open(path, "rb")
+    except OSError:
         return None
+    with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[:8] != SNAPSHOT_MAGIC:
+            return None
+        size = int.from_bytes(mm[8:12], "little")
+        header = json.loads(mm[12:12 + size])
+        if (header["guild_id"], header["data_rev"], header["schema"], header["byteorder"], header["itemsizes"]) != (
+            guild_id, rev, schema, sys.byteorder, _snapshot_itemsizes()
+        ) or header["scalars"]["count"] != rows:
+            return None
+        if any(offset < 0 or offset + n > len(mm) for _, offset, n in header["columns"].values()):
+            raise ValueError(f"snapshot truncated at {len(mm)} bytes")
+        view = memoryview(mm)
+        try:
+            columns = {
+                name: (typecode, view[offset:offset + n])
+                for name, (typecode, offset, n) in header["columns"].items()
+            }
+            order_tc, order_buf = columns.pop("list_order")
+            new_store = RecordStore.from_snapshot(columns, header["scalars"])
+            order = array(order_tc)
+            order.frombytes(order_buf)
+            columns = order_buf = None
+        finally:
+            view.release()
+    if len(order) != new_store.count:
+        raise ValueError(f"snapshot list order holds {len(order)} of {new_store.count} rows")
+    return new_store, order, rev
+
+def _build_index(src: RecordStore):
+    index = SearchIndex(src)
+    index.add_many(src.rows())
+    return index
+
+async def save_snapshot(cache: GuildCache) -> bool:
+    """Write the guild's cache to disk if it mirrors a DB revision not saved yet."""
+    rev = cache.rev
+    if rev is None or rev == cache.snapshot_rev:
+        return False
+    # copy on the loop so the columns and rev belong together; write off it
+    columns, scalars = cache.store.snapshot_state()
+    columns["list_order"] = (cache.list_order.typecode, bytes(cache.list_order))
+    schema = len(MIGRATIONS)
+    path = snapshot_path(cache.guild_id)
+    if await asyncio.to_thread(_write_snapshot, path, cache.guild_id, rev, schema, columns, scalars):
+        cache.snapshot_rev = rev
+        return True
+    return False
+
+async def load_snapshot(guild_id: int) -> bool:
+    """Serve from the snapshot right away; the search index is filled in behind it."""
+    try:
+        loaded = await db_read(_read_snapshot, guild_id, snapshot_path(guild_id))
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"⚠️ Snapshot of guild {guild_id} unreadable, rebuilding:", repr(e))
+        return False
+    if loaded is None:
+        return False
+    new_store, order, rev = loaded
+    if guild_id in journal.pending or _latest_rev.get(guild_id, rev) > rev:
+        return False  # written to while it was being read
+    # exact lookups work now; prefix/fuzzy once the index lands
+    cache = _install_cache(guild_id, new_store, SearchIndex(new_store), order, rev)
+    cache.snapshot_rev = rev
+    print(f"⚡ Cache loaded from snapshot for guild {guild_id}: "
+          f"{new_store.count} names, {new_store.code_count} codes (rev {rev})")
+    asyncio.create_task(_warm_search_index(cache))
+    return True
+
+async def _warm_search_index(cache: GuildCache):
+    generation = cache.generation
+    try:
+        index = await asyncio.to_thread(_build_index, cache.store)
+    except Exception:
+        index = None
+    if caches.get(cache.guild_id) is not cache:
+        return  # evicted or reloaded meanwhile
+    if index is None or cache.generation != generation:
+        await load_cache(cache.guild_id)  # the store changed during the build; take the slow, safe path
+        return
+    cache.search_index = index
+    bump_generation(cache)  # replies cached without prefix/fuzzy matches are now stale
+
+async def cache_loop():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        for cache in list(caches.values()):
+            try:
+                await save_snapshot(cache)
+            except OSError as e:
+                print("⚠️ Snapshot not saved:", repr(e))
+        await evict_idle()
+        if time.monotonic() - _compacted_at >= CHANGES_COMPACT_INTERVAL:
+            try:
+                superseded, expired = await compact_changes()
+                print(f"🧹 Change log compacted: {superseded} superseded, {expired} old deletes dropped")
+            except sqlite3.Error as e:
+                print("⚠️ Change log not compacted:", repr(e))
 
-    name_db, code_db, uid_db = row
-    return (normalize_name(name_db), normalize_code(code_db) if code_db else None, str(uid_db))
-
-def delete_one_by_key(key: str):
-    row = find_row_by_key(key)
-    if not row:
-        return False, None
+# =========================
+# Write journal (group commit)
+# =========================
+# Mutations patch the guild's cache at once and queue here; one flusher task
+# hands them to the writer thread in submission order, many per transaction,
+# so concurrent writers share a commit instead of queueing one commit each.
+# A caller's write() returns once its group is committed, so anything that was
+# acknowledged survives a crash; whatever is still queued is committed by
+# flush() on shutdown.
+JOURNAL_GROUP_ROWS = 5000  # queued rows that close a group straight away
+JOURNAL_DELAY = 0.02       # seconds a group stays open for more writers
+
+# Each op also appends its effect to the change log (see _migrate_change_log) in
+# the same transaction: 'put' for a row written, 'del' for a row removed.
+def _log_changes(conn, entries):
+    conn.executemany(
+        "INSERT INTO changes (guild_id, at, op, name, code, user_id) VALUES (?, ?, ?, ?, ?, ?)", entries
+    )
 
-    name_db, code_db, uid_db = row
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM users WHERE name = ?", (name_db,))
-    conn.commit()
-    conn.close()
+def _upsert_rows(conn, guild_id: int, records, at: int):
+    # REPLACE also deletes a row whose code is taken by a record with another name;
+    # replay that on the current owners of the batch's codes to log their tombstones
+    holder = {}  # code -> name holding it
+    codes = list({cc for _, cc, _ in records if cc})
+    for i in range(0, len(codes), SQL_CHUNK):
+        chunk = codes[i:i + SQL_CHUNK]
+        # joined from VALUES: with `code IN (...)` the planner scans users_order for the whole guild
+        values = ",".join(["(?)"] * len(chunk))
+        holder.update(conn.execute(
+            f"SELECT v.column1, name FROM (VALUES {values}) AS v JOIN users ON guild_id = ? AND code = v.column1",
+            (*chunk, guild_id)
+        ))
+    code_of = {nn: cc for cc, nn in holder.items()}
+    log = []
+    for nn, cc, uid in records:
+        old = code_of.pop(nn, None)
+        if old is not None and holder.get(old) == nn:
+            del holder[old]
+        if cc:
+            prev = holder.get(cc)
+            if prev is not None and prev != nn:
+                log.append((guild_id, at, "del", prev, None, None))
+                del code_of[prev]
+            holder[cc] = nn
+            code_of[nn] = cc
+        log.append((guild_id, at, "put", nn, cc, uid))
+    conn.executemany(
+        "INSERT OR REPLACE INTO users (guild_id, name, code, user_id) VALUES (?, ?, ?, ?)",
+        ((guild_id, *rec) for rec in records)
+    )
+    _log_changes(conn, log)
+
+def _delete_rows(conn, guild_id: int, records, at: int):
+    # the whole record must match: a row rewritten since it was resolved stays
+    rows = [(guild_id, name, code, user_id) for name, code, user_id in records]
+    conn.executemany("""
+        INSERT INTO changes (guild_id, at, op, name)
+        SELECT guild_id, ?, 'del', name FROM users WHERE guild_id = ? AND name = ? AND code IS ? AND user_id = ?
+    """, [(at, *row) for row in rows])
+    conn.executemany("DELETE FROM users WHERE guild_id = ? AND name = ? AND code IS ? AND user_id = ?", rows)
+
+def _clear_rows(conn, guild_id: int, _, at: int):
+    conn.execute("""
+        INSERT INTO changes (guild_id, at, op, name)
+        SELECT guild_id, ?, 'del', name FROM users WHERE guild_id = ?
+    """, (at, guild_id))
+    conn.execute("DELETE FROM users WHERE guild_id = ?", (guild_id,))
+
+JOURNAL_OPS = {"upsert": _upsert_rows, "delete": _delete_rows}
+
+def _commit_group(conn, group):
+    """Apply (guild_id, op, payload) mutations in order in one transaction; new data_rev per guild."""
+    at = int(time.time())
+    with conn:  # commit on success, rollback on any error
+        for guild_id, op, payload in group:
+            JOURNAL_OPS[op](conn, guild_id, payload, at)
+        return {guild_id: _bump_data_rev(conn, guild_id) for guild_id in dict.fromkeys(g for g, _, _ in group)}
+
+class WriteJournal:
+    def __init__(self):
+        self.queue = []  # (guild_id, op, payload, future), oldest first
+        self.rows = 0
+        self.pending = {}  # guild_id -> mutations submitted but not committed yet
+        self.turns = {}  # guild_id -> Lock a writer holds while it patches the cache and submits
+        self.commits = 0
+        self.mutations = 0
+        self._task = None
+        self._full = None
+
+    def submit(self, guild_id: int, op: str, payload=None) -> asyncio.Future:
+        """Queue a mutation whose cache change is already made; the future resolves at its commit."""
+        fut = asyncio.get_running_loop().create_future()
+        self.queue.append((guild_id, op, payload, fut))
+        self.rows += len(payload) if payload else 1
+        self.pending[guild_id] = self.pending.get(guild_id, 0) + 1
+        cache = caches.get(guild_id)
+        if cache is not None:
+            _cache_at(cache, None)  # ahead of the DB until the group commits
+        if self.rows >= JOURNAL_GROUP_ROWS and self._full is not None and not self._full.done():
+            self._full.set_result(None)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return fut
+
+    def turn(self, guild_id: int) -> asyncio.Lock:
+        lock = self.turns.get(guild_id)
+        if lock is None:
+            lock = self.turns[guild_id] = asyncio.Lock()
+        return lock
+
+    async def write(self, guild_id: int, op: str, payload=None) -> int:
+        return await self.wait(self.submit(guild_id, op, payload))
+
+    async def wait(self, fut: asyncio.Future) -> int:
+        """Await a submitted mutation's commit; the wait counts as DB time."""
+        t0 = time.perf_counter()
+        try:
+            return await fut
+        finally:
+            _add_stat("db", time.perf_counter() - t0)
 
-    cache_name.pop(name_db, None)
-    if code_db:
-        cache_code.pop(code_db, None)
+    async def flush(self, guild_id: int = None):
+        """Wait until everything queued so far (for guild_id, or for all guilds) is committed."""
+        while self._task is not None and (guild_id is None or guild_id in self.pending):
+            await asyncio.shield(self._task)
 
-    return True, (name_db, code_db, uid_db)
+    async def _run(self):
+        try:
+            while self.queue:
+                if self.rows < JOURNAL_GROUP_ROWS:
+                    self._full = asyncio.get_running_loop().create_future()
+                    await asyncio.wait([self._full], timeout=JOURNAL_DELAY)
+                    self._full = None
+                group, self.queue, self.rows = self.queue, [], 0
+                await self._commit(group)
+        finally:
+            self._task = None
+
+    async def _commit(self, group):
+        revs, error = None, None
+        try:
+            revs = await db_write(_commit_group, [(guild_id, op, payload) for guild_id, op, payload, _ in group])
+        except Exception as e:
+            error = e
+            print("⚠️ Group commit failed:", repr(e))
+        for guild_id, _, _, fut in group:
+            self.pending[guild_id] -= 1
+            if not self.pending[guild_id]:
+                del self.pending[guild_id]
+            if fut.done():
+                continue
+            if error is not None:
+                fut.set_exception(error)
+            else:
+                fut.set_result(revs[guild_id])
+        if error is not None:
+            for guild_id in {guild_id for guild_id, *_ in group}:
+                caches.pop(guild_id, None)  # patched ahead of a write that failed; reload from the DB
+            return
+        self.commits += 1
+        self.mutations += len(group)
+        for guild_id, rev in revs.items():
+            cache = _cache_written(guild_id, rev)
+            # a writer holding the turn is patching the cache ahead of the DB
+            busy = guild_id in self.pending or self.turn(guild_id).locked()
+            if cache is not None and not busy and not cache.lagging:
+                _cache_at(cache, rev)
+
+journal = WriteJournal()
+metrics.gauge("bot_journal_queue_rows", "Rows waiting for the next group commit", lambda: journal.rows)
+metrics.gauge("bot_journal_commits_total", "Group commits", lambda: journal.commits, kind="counter")
+metrics.gauge("bot_journal_mutations_total", "Mutations committed by group commits",
+              lambda: journal.mutations, kind="counter")
 
-def delete_all():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM users")
-    conn.commit()
-    conn.close()
-    load_cache()
+# =========================
+# Operations
+# =========================
+def bump_generation(cache: GuildCache):
+    global data_generation
+    data_generation += 1
+    cache.generation = data_generation
+
+def _cache_at(cache: GuildCache, rev):
+    # the DB data_rev the cache mirrors; None while the two differ (queued writes, lagging)
+    cache.rev = rev
+
+def _cache_put(cache: GuildCache, rec):
+    # mirror INSERT OR REPLACE: a row that collides on name or code is dropped
+    store = cache.store
+    nn, cc, uid = rec
+    for row in (store.row_of_name(nn), store.row_of_code(cc) if cc else None):
+        if store.alive(row):
+            _cache_drop_row(cache, row)
+    row = store.put(nn, cc, uid)
+    cache.search_index.add(row)
+    insort(cache.list_order, row, key=store.order_key)
+
+def _cache_put_many(cache: GuildCache, records):
+    for rec in records:
+        _cache_put(cache, rec)
+
+async def _patch_cache(guild_id: int, patch, items):
+    """Apply patch(cache, chunk of items) to the guild's cache, if loaded; the caller holds its turn.
+
+    The cache is patched in slices of CACHE_PATCH_SLICE seconds with the
+    loop let go in between, so a big batch does not stall heartbeats.
+    """
+    cache = caches.get(guild_id)  # an unloaded guild reads the rows from the DB when it loads
+    while cache is not None:
+        _cache_at(cache, None)  # ahead of the DB from the first chunk on
+        t0 = time.perf_counter()
+        for i in range(0, len(items), CACHE_PATCH_CHUNK):
+            if time.perf_counter() - t0 >= CACHE_PATCH_SLICE:
+                await asyncio.sleep(0)
+                if caches.get(guild_id) is not cache:
+                    break
+                t0 = time.perf_counter()
+            patch(cache, items[i:i + CACHE_PATCH_CHUNK])
+            bump_generation(cache)  # also tells a search index build running meanwhile to start over
+        else:
+            return
+        cache = caches.get(guild_id)  # reloaded meanwhile, without these rows: patch the new one
+
+async def _write(guild_id: int, op: str, payload, patch=None):
+    """Patch the guild's cache with patch(cache, chunk of payload), then queue op and await its commit.
+
+    Writers take turns per guild, so the cache sees their changes in
+    commit order.
+    """
+    async with journal.turn(guild_id):
+        if patch is not None:
+            await _patch_cache(guild_id, patch, payload)
+        fut = journal.submit(guild_id, op, payload)
+    return await journal.wait(fut)
+
+async def upsert_many(guild_id: int, records):
+    """Put (name, code, user_id) records in the guild's cache, then await their group commit."""
+    if not records:
+        return
+    count_rows(len(records))
+    cache = caches.get(guild_id)
+    if cache is None or len(records) < max(CACHE_RESORT_MIN, cache.store.count // 8):
+        await _write(guild_id, "upsert", records, _cache_put_many)
+        return
+    # big batch: rebuilding the cache on a reader thread beats patching it row by row on the loop
+    cache.lagging = True  # it catches up in load_cache below
+    await _write(guild_id, "upsert", records)
+    if guild_id in caches:
+        await load_cache(guild_id)
+
+def _cache_drop_row(cache: GuildCache, row: int):
+    store = cache.store
+    cache.search_index.remove(row)
+    i = bisect_left(cache.list_order, store.order_key(row), key=store.order_key)
+    if i < len(cache.list_order) and cache.list_order[i] == row:
+        del cache.list_order[i]
+    store.drop(row)
+
+def _cache_drop(cache: GuildCache, rec):
+    row = cache.store.row_of_name(rec[0])
+    if row is not None and cache.store.record(row) == rec:
+        _cache_drop_row(cache, row)
+
+def _cache_drop_many(cache: GuildCache, records):
+    for rec in records:
+        _cache_drop(cache, rec)
+
+def resolve_key(cache: GuildCache, key: str):
+    return cache.store.find(key)
+
+async def delete_keys(guild_id: int, keys):
+    """Delete the records keys (names, codes) resolve to; (records deleted, keys matching none).
+
+    Keys are resolved inside the guild's writer turn: a write still
+    patching the cache could otherwise change a row between its lookup
+    and its delete.
+    """
+    await get_cache(guild_id)  # loaded before the turn, so other writers are not held up by it
+    records, seen, bad = [], set(), 0
+    async with journal.turn(guild_id):
+        cache = await get_cache(guild_id)
+        for key in keys:
+            rec = resolve_key(cache, key)
+            if not rec or rec[0] in seen:
+                bad += 1
+                continue
+            seen.add(rec[0])
+            records.append(rec)
+        if not records:
+            return records, bad
+        count_rows(len(records))
+        await _patch_cache(guild_id, _cache_drop_many, records)
+        fut = journal.submit(guild_id, "delete", records)
+    await journal.wait(fut)
+    return records, bad
 
 def split_query_items(query: str):
     q = str(query).strip()
@@ -213,16 +2149,40 @@ def split_query_items(query: str):
             items.append(p.strip())
     return items
 
-def lookup_records(query: str):
+def search_records(cache: GuildCache, query: str, limit: int = SEARCH_LIMIT, fuzzy: bool = True):
+    out = []
+    for kind, key in cache.search_index.search(query, limit, fuzzy):
+        rec = cache.store.get(kind, key)
+        if rec:
+            out.append(rec)
+    return out
+
+def lookup_records(cache: GuildCache, query: str):
+    items = split_query_items(query)
     found = []
     seen = set()
-    for item in split_query_items(query):
-        nn = normalize_name(item)
-        cc = normalize_code(item)
-        rec = cache_name.get(nn) or cache_code.get(cc)
+    for item in items:
+        rec = cache.store.find(item)
         if rec and rec[2] not in seen:
             found.append(rec)
             seen.add(rec[2])
+    if found or not items:
+        count_rows(len(found))
+        return found
+
+    # no exact hit: ranked prefix/fuzzy matches for the full phrase,
+    # falling back to its single words
+    for rec in search_records(cache, items[0]):
+        if rec[2] not in seen:  # a name and a code of one record can both match
+            found.append(rec)
+            seen.add(rec[2])
+    if not found:
+        for item in items[1:]:
+            for rec in search_records(cache, item):
+                if rec[2] not in seen and len(found) < SEARCH_LIMIT:
+                    found.append(rec)
+                    seen.add(rec[2])
+    count_rows(len(found))
     return found
 
 def format_results(records):
@@ -236,85 +2196,811 @@ def format_results(records):
     ids_block = "```" + "\n".join(ids_only) + "```" if ids_only else "```-```"
     return pretty, ids_block
 
-def list_all_records():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT name, code, user_id FROM users ORDER BY code IS NULL, code, name")
-    rows = c.fetchall()
-    conn.close()
-    out = []
-    for n, code, uid in rows:
-        out.append((normalize_name(n), normalize_code(code) if code else None, str(uid)))
-    return out
+def _select_all_records(conn, guild_id: int):
+    return list(iter_records(conn, guild_id))
+
+async def list_all_records(guild_id: int):
+    return await db_read(_select_all_records, guild_id)
+
+def _adopt_legacy(conn, guild_id: int):
+    # rows from before per-guild storage (guild 0) join guild_id; its own rows win on conflicts
+    with conn:
+        at = int(time.time())
+        # log first: the rows INSERT OR IGNORE will take are the ones clashing with nothing
+        conn.execute("""
+            INSERT INTO changes (guild_id, at, op, name, code, user_id)
+            SELECT ?, ?, 'put', name, code, user_id FROM users AS old WHERE guild_id = 0
+            AND NOT EXISTS (SELECT 1 FROM users WHERE guild_id = ? AND name = old.name)
+            AND (code IS NULL OR NOT EXISTS (SELECT 1 FROM users WHERE guild_id = ? AND code = old.code))
+        """, (guild_id, at, guild_id, guild_id))
+        moved = conn.execute("""
+            INSERT OR IGNORE INTO users (guild_id, name, code, user_id)
+            SELECT ?, name, code, user_id FROM users WHERE guild_id = 0
+        """, (guild_id,)).rowcount
+        left = conn.execute("SELECT count(*) FROM users WHERE guild_id = 0").fetchone()[0]
+        _clear_rows(conn, 0, None, at)
+        _bump_data_rev(conn, 0)
+        return moved, left - moved, _bump_data_rev(conn, guild_id)
+
+def _count_legacy(conn):
+    return conn.execute("SELECT count(*) FROM users WHERE guild_id = 0").fetchone()[0]
+
+async def adopt_on_ready():
+    """Hand unassigned rows to the bot's only guild, or say loudly where they are."""
+    legacy = await db_read(_count_legacy)
+    if not legacy:
+        return
+    if len(bot.guilds) == 1:
+        guild = bot.guilds[0]
+        moved, skipped = await adopt_legacy(guild.id)
+        print(f"📥 {moved} records from before per-guild storage adopted by {guild.name} ({guild.id}), "
+              f"{skipped} duplicates skipped")
+        return
+    print(f"⚠️ {legacy} records from before per-guild storage belong to no guild and are not served. "
+          f"Set GUILD_ID to their server's ID and restart, or run !adopt in that server.")
+
+async def adopt_legacy(guild_id: int):
+    """Move the unassigned rows into guild_id; (moved, skipped as duplicates)."""
+    await journal.flush()  # the guild's queued writes go first
+    moved, skipped, rev = await db_write(_adopt_legacy, guild_id)
+    caches.pop(0, None)
+    if _cache_written(guild_id, rev) is not None:
+        await load_cache(guild_id)
+    count_rows(moved)
+    return moved, skipped
 
 # =========================
 # Bulk parsing (multiline OR single-line)
 # =========================
-def parse_bulk_any(text: str):
-    raw = str(text).strip()
-    if not raw:
-        return []
+PARSE_MODE_PROBE = 64 * 1024  # no newline within this much input -> single-line mode
+_ID_START = re.compile(r"(?<!\d)(?=\d{15,})")
+_HEADER_FIELDS = {"id": "id", "user_id": "id", "name": "name", "code": "code"}
 
-    # multiline
-    if "\n" in raw:
-        lines = [l.strip() for l in raw.splitlines() if l.strip()]
-        entries = []
-        for line in lines:
-            parts = line.split()
-            if len(parts) < 3:
-                continue
-            user_id = parts[0]
-            code = parts[-1]
-            name = " ".join(parts[1:-1])
-            entries.append((user_id, name, normalize_code(code)))
-        return entries
-
-    # single line: split at each ID (15+ digits)
-    segments = [s.strip() for s in re.split(r'(?=\d{15,})', raw) if s.strip()]
-    entries = []
-    for seg in segments:
-        parts = seg.split()
-        if len(parts) < 3:
-            continue
-        user_id = parts[0]
-        code = parts[-1]
-        name = " ".join(parts[1:-1])
-        entries.append((user_id, name, normalize_code(code)))
+def _parse_segment(seg: str):
+    parts = seg.split()
+    if len(parts) < 3:
+        return None
+    user_id = parts[0]
+    code = parts[-1]
+    name = " ".join(parts[1:-1])
+    return (user_id, name, normalize_code(code))
+
+class BulkParser:
+    """Incremental parse_bulk_any: feed() text pieces, get entries back as they complete.
+
+    Besides "ID name code" lines it understands the export formats
+    (tsv/csv with a code/name/id header, jsonl), so ids.txt can be re-imported.
+    """
+
+    def __init__(self):
+        self.mode = None      # "lines" | "segments"
+        self.columns = None   # header -> (delimiter, {field: index})
+        self.first = True
+        self.buf = ""
+
+    def feed(self, text: str):
+        self.buf += text
+        if self.mode is None:
+            if "\n" in self.buf:
+                self.mode = "lines"
+            elif len(self.buf) >= PARSE_MODE_PROBE:
+                self.mode = "segments"
+            else:
+                return
+        if self.mode == "lines":
+            head, sep, self.buf = self.buf.rpartition("\n")
+            for line in head.split("\n"):
+                entry = self._line(line)
+                if entry:
+                    yield entry
+        else:
+            # the last segment may still be growing
+            starts = [m.start() for m in _ID_START.finditer(self.buf)]
+            if not starts:
+                self.buf = self.buf[-32:]  # no ID yet: keep only a possible partial one
+                return
+            if len(starts) < 2:
+                return
+            head, self.buf = self.buf[:starts[-1]], self.buf[starts[-1]:]
+            yield from self._segments(head)
+
+    def close(self):
+        rest, self.buf = self.buf, ""
+        if self.mode is None:
+            self.mode = "lines" if "\n" in rest.strip() else "segments"
+        if self.mode == "lines":
+            for line in rest.split("\n"):
+                entry = self._line(line)
+                if entry:
+                    yield entry
+        else:
+            yield from self._segments(rest)
+
+    def _segments(self, text: str):
+        for seg in _ID_START.split(text):
+            entry = _parse_segment(seg)
+            if entry:
+                yield entry
+
+    def _line(self, raw: str):
+        line = raw.strip()
+        if not line:
+            return None
+        if self.first:
+            self.first = False
+            if self._header(line):
+                return None
+        if self.columns:
+            delim, cols = self.columns
+            raw = raw.strip("\r\n")  # keep empty leading columns
+            fields = next(csv.reader([raw])) if delim == "," else raw.split("\t")
+            try:
+                user_id, name, code = (fields[cols[f]].strip() for f in ("id", "name", "code"))
+            except IndexError:
+                return None
+            return (user_id, name, normalize_code(code) if code else "")
+        if line.startswith("{"):
+            try:
+                obj = json.loads(line)
+            except ValueError:
+                return None
+            code = obj.get("code") or ""
+            return (str(obj.get("id") or obj.get("user_id") or ""), str(obj.get("name") or ""), normalize_code(code) if code else "")
+        return _parse_segment(line)
+
+    def _header(self, line: str) -> bool:
+        delim = "\t" if "\t" in line else ","
+        names = [f.strip().lower() for f in line.split(delim)]
+        cols = {_HEADER_FIELDS[n]: i for i, n in enumerate(names) if n in _HEADER_FIELDS}
+        if len(cols) != 3:
+            return False
+        self.columns = (delim, cols)
+        return True
+
+def parse_bulk_any(text: str):
+    parser = BulkParser()
+    entries = list(parser.feed(str(text).strip()))
+    entries.extend(parser.close())
     return entries
 
-def bulk_upsert(text: str):
-    parsed = parse_bulk_any(text)
-    ok, bad = 0, 0
+def validate_entries(parsed):
+    records = []
     bad_lines = []
-
     for user_id, name, code in parsed:
         if not is_valid_id(user_id):
-            bad += 1
             bad_lines.append(f"(ID غير صحيح) {user_id} | {name} | {code}")
             continue
         if not name or not code:
-            bad += 1
             bad_lines.append(f"(نقص بيانات) {user_id} | {name} | {code}")
             continue
-        upsert_user(name, code, user_id)
-        ok += 1
+        nn, cc = normalize_name(name), normalize_code(code)
+        if key_too_long(nn) or key_too_long(cc):
+            bad_lines.append(f"(طويل جدًا) {user_id} | {name[:40]} | {code[:40]}")
+            continue
+        records.append((nn, cc, str(user_id)))
+    return records, bad_lines
 
-    return ok, bad, bad_lines
+async def bulk_upsert(guild_id: int, text: str):
+    records, bad_lines = validate_entries(parse_bulk_any(text))
+    await upsert_many(guild_id, records)
+    return len(records), len(bad_lines), bad_lines
 
-def delete_many(keys_text: str):
+async def delete_many(guild_id: int, keys_text: str):
     lines = [l.strip() for l in str(keys_text).splitlines() if l.strip()]
-    ok, bad = 0, 0
-    for key in lines:
-        deleted, _ = delete_one_by_key(key)
-        if deleted:
-            ok += 1
+    records, bad = await delete_keys(guild_id, lines)
+    return len(records), bad
+
+# =========================
+# File import (streamed)
+# =========================
+IMPORT_EXTENSIONS = (".txt", ".csv", ".tsv", ".jsonl")
+IMPORT_MAX_BYTES = 50 * 1024 * 1024
+IMPORT_READ = 64 * 1024        # bytes pulled from the download per step
+IMPORT_BATCH = 2000            # records per write transaction
+IMPORT_PROGRESS_EVERY = 2.0    # seconds between progress edits
+
+class ImportResult:
+    def __init__(self):
+        self.ok = 0
+        self.bad = 0
+        self.bad_lines = []  # first few, for the reply
+        self.bytes = 0
+
+async def import_stream(guild_id: int, chunks, progress=None):
+    """Parse an async stream of byte chunks and upsert it into a guild batch by batch.
+
+    Memory stays at one read chunk plus one batch whatever the file size.
+    A file that fits in one batch patches the cache like bulk_upsert; bigger
+    ones are written batch by batch and a loaded cache is rebuilt once at the
+    end (re-sorting it after every batch costs more than the whole rebuild).
+    `progress(result)` is awaited after each batch.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    parser = BulkParser()
+    result = ImportResult()
+    batch = []
+    deferred = False
+
+    async def flush(final: bool = False):
+        nonlocal deferred
+        records, bad_lines = validate_entries(batch)
+        batch.clear()
+        if final and not deferred:
+            await upsert_many(guild_id, records)
+        elif records:
+            deferred = True
+            cache = caches.get(guild_id)
+            if cache is not None:
+                cache.lagging = True  # it catches up in load_cache below
+            count_rows(len(records))
+            await _write(guild_id, "upsert", records)
+        result.ok += len(records)
+        result.bad += len(bad_lines)
+        result.bad_lines.extend(bad_lines[:5 - len(result.bad_lines)])
+        if progress:
+            await progress(result)
+
+    try:
+        async for chunk in chunks:
+            result.bytes += len(chunk)
+            for entry in parser.feed(decoder.decode(chunk)):
+                batch.append(entry)
+                if len(batch) >= IMPORT_BATCH:
+                    await flush()
+        batch.extend(parser.feed(decoder.decode(b"", final=True)))
+        batch.extend(parser.close())
+        await flush(final=True)
+    finally:
+        # also when the download fails part way: batches already committed must reach the cache
+        if deferred and guild_id in caches:
+            await load_cache(guild_id)
+    return result
+
+async def iter_attachment(attachment: discord.Attachment):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(attachment.url) as resp:
+            resp.raise_for_status()
+            async for chunk in resp.content.iter_chunked(IMPORT_READ):
+                yield chunk
+
+def import_message(result: ImportResult, total: int = 0, done: bool = False):
+    if done:
+        msg = f"✅ تمت إضافة/تحديث: {result.ok}\n❌ سجلات فشلت: {result.bad}"
+        if result.bad_lines:
+            msg += "\n\nأول أخطاء:\n```" + "\n".join(result.bad_lines) + "```"
+        return msg
+    pct = f" ({result.bytes * 100 // total}%)" if total else ""
+    return f"⏳ جاري الاستيراد{pct}... تمت معالجة: {result.ok} | فشلت: {result.bad}"
+
+async def import_attachment(interaction: discord.Interaction, attachment: discord.Attachment):
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    last = time.monotonic()
+
+    # progress edits never hold up the import; queued ones collapse into the newest
+    route = route_key("PATCH", f"/webhooks/{interaction.application_id}/{interaction.token}/messages/@original")
+    key = ("import", interaction.id)
+
+    def edit(content: str):
+        return lambda: interaction.edit_original_response(content=content)
+
+    async def progress(result):
+        nonlocal last
+        if time.monotonic() - last >= IMPORT_PROGRESS_EVERY:
+            last = time.monotonic()
+            outbound.submit(route, edit(import_message(result, attachment.size)), key)
+
+    try:
+        result = await import_stream(interaction.guild_id, iter_attachment(attachment), progress)
+    except aiohttp.ClientError:
+        await outbound.run(route, edit("❌ تعذر تحميل الملف، جرّب مرة ثانية."), key)
+        return
+    await outbound.run(route, edit(import_message(result, done=True)), key)
+
+# =========================
+# Change log (delta exports)
+# =========================
+# Writes log 'put' / 'del' entries (see JOURNAL_OPS); a delta export replays the
+# entries after a sequence number, so a synced copy only fetches what changed.
+# Compaction keeps each name's last entry only and drops old tombstones; a delta
+# from before the newest dropped tombstone (the guild's floor) would miss deletes
+# and is refused.
+CHANGES_TOMBSTONE_DAYS = 30          # deletes stay in the log this long
+CHANGES_COMPACT_INTERVAL = 6 * 3600.0
+_compacted_at = time.monotonic()
+
+def iter_changes(conn, guild_id: int, since: int, upto: int, since_at: int = 0):
+    """(op, name, code, user_id) for each name changed in (since, upto], its last change only."""
+    c = conn.cursor()
+    c.execute(
+        "SELECT op, name, code, user_id FROM changes WHERE guild_id = ? AND seq > ? AND seq <= ? AND at >= ?"
+        " ORDER BY seq",
+        (guild_id, since, upto, since_at)
+    )
+    latest = {}  # name -> entry, in order of each name's last change
+    for entry in c:
+        latest.pop(entry[1], None)
+        latest[entry[1]] = entry
+    return latest.values()
+
+def _changes_head(conn) -> int:
+    # AUTOINCREMENT's high-water mark: unlike max(seq) it stays put when compaction drops the newest entries
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+    return row[0] if row else 0
+
+def _changes_floor(conn, guild_id: int):
+    """(seq, unix time) a delta must start from; older ones may have lost tombstones."""
+    value = _get_meta(conn, f"changes_floor:{guild_id}")
+    seq, at = value.split() if value else (0, 0)
+    return int(seq), int(at)
+
+def _compact_changes(conn, now: int):
+    cutoff = now - CHANGES_TOMBSTONE_DAYS * 86400
+    with conn:
+        superseded = conn.execute("""
+            DELETE FROM changes WHERE seq NOT IN (SELECT max(seq) FROM changes GROUP BY guild_id, name)
+        """).rowcount
+        floors = conn.execute(
+            "SELECT guild_id, max(seq) FROM changes WHERE op = 'del' AND at < ? GROUP BY guild_id", (cutoff,)
+        ).fetchall()
+        conn.executemany(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            ((f"changes_floor:{guild_id}", f"{seq} {cutoff}") for guild_id, seq in floors)
+        )
+        expired = conn.execute("DELETE FROM changes WHERE op = 'del' AND at < ?", (cutoff,)).rowcount
+    return superseded, expired
+
+async def compact_changes():
+    """Drop superseded change log entries and expired tombstones; (superseded, expired)."""
+    global _compacted_at
+    _compacted_at = time.monotonic()
+    return await db_write(_compact_changes, int(time.time()))
+
+def parse_since(text: str):
+    """(seq, unix time) to export changes after: a sequence number or an ISO date (UTC); None if neither."""
+    text = text.strip()
+    if text.isdigit():
+        return int(text), 0
+    try:
+        when = datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return 0, int(when.timestamp())
+
+# =========================
+# Export (streamed)
+# =========================
+EXPORT_FORMATS = {"tsv": "txt", "csv": "csv", "jsonl": "jsonl"}  # format -> file extension
+EXPORT_CHUNK = 1000                 # rows fetched per cursor step
+EXPORT_SPOOL = 1024 * 1024          # a part stays in memory up to this size, then spills to disk
+EXPORT_MARGIN = 256 * 1024          # headroom under the attachment limit (gzip buffering)
+EXPORT_DEFAULT_LIMIT = 10 * 1024 * 1024
+
+def iter_records(conn, guild_id: int, chunk: int = EXPORT_CHUNK):
+    c = conn.cursor()
+    c.execute(
+        "SELECT name, code, user_id FROM users WHERE guild_id = ? ORDER BY code IS NULL, code, name",
+        (guild_id,)
+    )
+    while True:
+        rows = c.fetchmany(chunk)
+        if not rows:
+            break
+        yield from rows
+
+class ExportWriter:
+    """Encodes records into one or more size-limited (optionally gzipped) spooled files."""
+
+    def __init__(self, fmt: str, gz: bool, limit: int, delta: bool = False):
+        self.fmt = fmt
+        self.gz = gz
+        self.delta = delta  # records are change log entries: (op, name, code, user_id)
+        self.seq = 0  # change log position the export is current to
+        self.limit = max(limit - EXPORT_MARGIN, EXPORT_MARGIN)
+        self.parts = []
+        self.rows = 0
+        self._raw = None
+        self._out = None
+        self._part_rows = 0
+        self._csv_buf = StringIO()
+        self._csv = csv.writer(self._csv_buf, lineterminator="\n")
+
+    def _header(self) -> bytes:
+        cols = ["op", "code", "name", "id"] if self.delta else ["code", "name", "id"]
+        if self.fmt == "tsv":
+            return ("\t".join(cols) + "\n").encode("utf-8")
+        if self.fmt == "csv":
+            return (",".join(cols) + "\n").encode("utf-8")
+        return b""
+
+    def _line(self, rec) -> bytes:
+        op = None
+        if self.delta:
+            op, *rec = rec
+        n, c, uid = rec
+        if self.fmt == "tsv":
+            return (f"{op}\t" * self.delta + f"{c or ''}\t{n}\t{uid or ''}\n").encode("utf-8")
+        if self.fmt == "csv":
+            self._csv_buf.seek(0)
+            self._csv_buf.truncate()
+            self._csv.writerow([op] * self.delta + [c or "", n, uid or ""])
+            return self._csv_buf.getvalue().encode("utf-8")
+        obj = {"op": op} if self.delta else {}
+        obj.update(code=c, name=n, id=uid)
+        return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+    def _open_part(self):
+        self._close_part()
+        self._raw = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL)
+        self._out = gzip.GzipFile(fileobj=self._raw, mode="wb", mtime=0) if self.gz else self._raw
+        self._out.write(self._header())
+        self._part_rows = 0
+        self.parts.append(self._raw)
+
+    def _close_part(self):
+        if self._out is not None and self._out is not self._raw:
+            self._out.close()  # flushes the gzip trailer, leaves _raw open
+        self._out = None
+
+    def write(self, rec):
+        data = self._line(rec)
+        if self._raw is None or (self._part_rows and self._raw.tell() + len(data) > self.limit):
+            self._open_part()
+        self._out.write(data)
+        self._part_rows += 1
+        self.rows += 1
+
+    def finish(self):
+        self._close_part()
+        for part in self.parts:
+            part.seek(0)
+        return self.parts
+
+    def filenames(self, base: str = "ids"):
+        ext = EXPORT_FORMATS[self.fmt] + (".gz" if self.gz else "")
+        if len(self.parts) == 1:
+            return [f"{base}.{ext}"]
+        return [f"{base}-{i}.{ext}" for i in range(1, len(self.parts) + 1)]
+
+def _export_parts(conn, guild_id: int, fmt: str, gz: bool, limit: int, since=None):
+    """All the guild's records, or with since=(seq, unix time) its changes after that; None if too old."""
+    writer = ExportWriter(fmt, gz, limit, delta=since is not None)
+    conn.execute("BEGIN")  # the rows and the log position must come from the same read snapshot
+    try:
+        writer.seq = _changes_head(conn)
+        if since is None:
+            records = iter_records(conn, guild_id)
         else:
-            bad += 1
-    return ok, bad
+            floor_seq, floor_at = _changes_floor(conn, guild_id)
+            since_seq, since_at = since
+            if since_seq < floor_seq and since_at < floor_at:
+                return None
+            records = iter_changes(conn, guild_id, since_seq, writer.seq, since_at)
+        for rec in records:
+            writer.write(rec)
+    finally:
+        conn.rollback()
+    writer.finish()
+    return writer
+
+async def send_export(interaction: discord.Interaction, fmt: str = "tsv", gz: bool = False, since=None):
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    limit = interaction.guild.filesize_limit if interaction.guild else EXPORT_DEFAULT_LIMIT
+    await journal.flush(interaction.guild_id)  # the log position must cover every acknowledged write
+    writer = await db_read(_export_parts, interaction.guild_id, fmt, gz, limit, since)
+    if writer is None:
+        await interaction.followup.send(
+            "❌ التغييرات من هذي النقطة انحذفت من السجل، سوّ تصدير كامل بدون since.", ephemeral=True
+        )
+        return
+    count_rows(writer.rows)
+    resume = f"\n🔖 للتحديث القادم استخدم since: `{writer.seq}`"
+    try:
+        if not writer.rows:
+            empty = "لا توجد تغييرات منذ آخر تصدير." if writer.delta else "لا توجد بيانات للتصدير."
+            await interaction.followup.send(empty + resume, ephemeral=True)
+            return
+
+        total = len(writer.parts)
+        kind = "التغييرات" if writer.delta else "التصدير"
+        filenames = writer.filenames("ids-delta" if writer.delta else "ids")
+        for i, (part, filename) in enumerate(zip(writer.parts, filenames), 1):
+            msg = f"📄 تم إنشاء ملف {kind}:" if total == 1 else f"📄 ملف {kind} ({i}/{total}):"
+            if i == total:
+                msg += resume
+            await interaction.followup.send(msg, file=discord.File(fp=part, filename=filename), ephemeral=True)
+    finally:
+        for part in writer.parts:
+            part.close()
+
+# =========================
+# Paged list (keyset)
+# =========================
+LIST_PAGE = 40
+LIST_CURSOR_MAX = 90  # custom_id is capped at 100 chars
+LIST_CURSOR_PREFIX = LIST_CURSOR_MAX - 18  # key chars an "h" cursor keeps beside its kind and digest
+
+def list_page(cache: GuildCache, after=None, before=None, size: int = LIST_PAGE):
+    """One page of records after/before a list_order key, plus its position."""
+    store, list_order = cache.store, cache.list_order
+    if before is not None:
+        end = bisect_left(list_order, before, key=store.order_key)
+        start = max(0, end - size)
+    else:
+        start = bisect_right(list_order, after, key=store.order_key) if after is not None else 0
+        end = start + size
+    records = [store.record(row) for row in list_order[start:end]]
+    count_rows(len(records))
+    return records, start, len(list_order)
+
+def _key_digest(rec) -> str:
+    return hashlib.blake2b(f"{rec[1] or ''}\n{rec[0]}".encode("utf-8"), digest_size=8).hexdigest()
+
+def _cursor_of(rec):
+    # codes are unique, so a code alone pins the row; fall back to the name
+    kind, key = ("c", rec[1]) if rec[1] else ("n", rec[0])
+    if len(key) <= LIST_CURSOR_MAX:
+        return kind, key
+    # too long for a custom_id: a prefix of the key, and a digest of the row's keys
+    # to tell it from the other rows sharing that prefix
+    return "h", f"{kind}{key[:LIST_CURSOR_PREFIX]}:{_key_digest(rec)}"
+
+def _long_cursor_key(cache: GuildCache, key: str):
+    store, list_order = cache.store, cache.list_order
+    head, digest = key.rsplit(":", 1)
+    kind, prefix = head[0], head[1:]
+    start = (False, prefix, "") if kind == "c" else (True, "", prefix)
+    part = 1 if kind == "c" else 2
+    # only the rows sharing the prefix are read
+    for i in range(bisect_left(list_order, start, key=store.order_key), len(list_order)):
+        order_key = store.order_key(list_order[i])
+        if order_key[0] != start[0] or not order_key[part].startswith(prefix):
+            break
+        if _key_digest(store.record(list_order[i])) == digest:
+            return order_key
+    return start  # gone: the start of its prefix range is the best guess
+
+def _cursor_key(cache: GuildCache, kind: str, key: str):
+    if kind == "h":
+        return _long_cursor_key(cache, key)
+    if kind == "c":
+        row = cache.store.row_of_code(key)
+        return cache.store.order_key(row) if row is not None else (False, key, "")
+    return (True, "", key)
+
+class ListPageButton(discord.ui.DynamicItem[discord.ui.Button], template=r"list:(?P<dir>[pn]):(?P<kind>[cnh]):(?P<key>.*)"):
+    """Prev/Next button whose custom_id carries the keyset cursor, so it survives restarts."""
+
+    def __init__(self, direction: str, kind: str, key: str, disabled: bool = False):
+        super().__init__(discord.ui.Button(
+            label="⬅️ السابق" if direction == "p" else "التالي ➡️",
+            style=discord.ButtonStyle.secondary,
+            custom_id=f"list:{direction}:{kind}:{key}",
+            disabled=disabled,
+        ))
+        self.direction = direction
+        self.kind = kind
+        self.key = key
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls(match["dir"], match["kind"], match["key"])
+
+    @instrumented("button:list_page")
+    async def callback(self, interaction: discord.Interaction):
+        cache = await interaction_cache(interaction)
+        cursor = _cursor_key(cache, self.kind, self.key)
+        if self.direction == "n":
+            page = list_page(cache, after=cursor)
+        else:
+            page = list_page(cache, before=cursor)
+        if not page[0]:
+            page = list_page(cache)
+        if not page[0]:
+            await respond(interaction, content="لا يوجد بيانات حاليًا.", ephemeral=True)
+            return
+        embed, view = render_list_page(*page)
+        if interaction.response.is_done():
+            await interaction.edit_original_response(embed=embed, view=view)
+        else:
+            await interaction.response.edit_message(embed=embed, view=view)
+
+def render_list_page(records, start: int, total: int):
+    lines = []
+    ids_only = []
+    for n, c, uid in records:
+        lines.append(f"{c or '-'} | {n} | {uid}")
+        ids_only.append(uid)
+
+    page = start // LIST_PAGE + 1
+    pages = max(1, -(-total // LIST_PAGE))
+    embed = discord.Embed(
+        title=f"📋 قائمة البيانات (صفحة {page}/{pages})",
+        description="**كود | اسم | ID**\n```" + "\n".join(lines) + "```"
+    )
+    embed.add_field(name="IDs فقط للنسخ", value="```" + "\n".join(ids_only) + "```", inline=False)
+    embed.set_footer(text=f"الإجمالي: {total} | للتصدير الكامل اضغط 📤 تصدير TXT")
+
+    view = discord.ui.View(timeout=None)
+    first_kind, first_key = _cursor_of(records[0])
+    last_kind, last_key = _cursor_of(records[-1])
+    view.add_item(ListPageButton("p", first_kind, first_key, disabled=start == 0))
+    view.add_item(ListPageButton("n", last_kind, last_key, disabled=start + len(records) >= total))
+    return embed, view
+
+# =========================
+# Reverse lookup (/whois)
+# =========================
+WHOIS_MAX_IDS = 100
+EMBED_FIELD_MAX = 1024
+EMBED_TOTAL_MAX = 5800  # Discord caps a whole embed at 6000 chars
+_ID_OR_MENTION = re.compile(r"<@!?(\d{15,})>|(?<!\d)(\d{15,})(?!\d)")
+
+def extract_ids(text: str):
+    """Distinct valid IDs from raw snowflakes and <@id> mentions, in input order."""
+    ids = {}
+    for m in _ID_OR_MENTION.finditer(str(text)):
+        uid = m.group(1) or m.group(2)
+        if is_valid_id(uid):
+            ids.setdefault(uid)
+    return list(ids)
+
+def whois_records(cache: GuildCache, text: str):
+    """(records, IDs with no record, IDs over the limit) for every ID in text."""
+    store = cache.store
+    ids = extract_ids(text)
+    found, missing = [], []
+    for uid in ids[:WHOIS_MAX_IDS]:
+        rows = list(store.rows_of_uid(int(uid)))
+        if not rows:
+            missing.append(uid)
+        elif len(rows) > 1:
+            rows.sort(key=store.order_key)
+        found.extend(store.record(row) for row in rows)
+    count_rows(len(found))
+    return found, missing, len(ids) - len(ids[:WHOIS_MAX_IDS])
+
+def _fit_blocks(lines, size: int = EMBED_FIELD_MAX):
+    # split lines into ``` blocks that each fit an embed field
+    blocks, cur, used = [], [], 6
+    for line in lines:
+        if cur and used + len(line) + 1 > size:
+            blocks.append("```" + "\n".join(cur) + "```")
+            cur, used = [], 6
+        cur.append(line[:size - 7])
+        used += len(line) + 1
+    if cur:
+        blocks.append("```" + "\n".join(cur) + "```")
+    return blocks
+
+def render_whois(found, missing, skipped: int):
+    """(embed, file or None); results that do not fit an embed go to whois.txt."""
+    pretty, _ = format_results(found)
+    lines = pretty[3:-3].split("\n") if found else []
+    embed = discord.Embed(title="✅ النتائج (كود | اسم | ID)")
+    file = None
+    blocks = _fit_blocks(lines)
+    if sum(len(b) for b in blocks) + len(missing) * 20 <= EMBED_TOTAL_MAX:
+        for i, block in enumerate(blocks):
+            embed.add_field(name=f"📌 العدد: {len(found)}" if i == 0 else "\u200b", value=block, inline=False)
+    else:
+        file = discord.File(fp=BytesIO(pretty[3:-3].encode("utf-8")), filename="whois.txt")
+        embed.description = f"📌 العدد: {len(found)} (النتائج كاملة في الملف)"
+    if missing:
+        block = _fit_blocks(missing)[0]
+        embed.add_field(name=f"❓ IDs غير مسجلة: {len(missing)}", value=block, inline=False)
+    if skipped:
+        embed.set_footer(text=f"تم تجاهل {skipped} ID (الحد {WHOIS_MAX_IDS} لكل طلب)")
+    return embed, file
+
+# =========================
+# /ids response cache
+# =========================
+IDS_CACHE_SIZE = 256
+
+class ResponseCache:
+    """Bounded LRU of rendered replies, each stamped with the data generation it was built at."""
+
+    MISS = object()
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # key -> (generation, value)
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, generation: int):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return self.MISS
+        if entry[0] != generation:
+            del self.entries[key]
+            self.stale += 1
+            self.misses += 1
+            return self.MISS
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, generation: int, value):
+        self.entries[key] = (generation, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+ids_cache = ResponseCache(IDS_CACHE_SIZE)
+for _stat in ("hits", "misses", "stale", "evictions"):
+    metrics.gauge(
+        f"bot_ids_cache_{_stat}_total", f"/ids response cache {_stat}",
+        lambda s=_stat: getattr(ids_cache, s), kind="counter"
+    )
+metrics.gauge("bot_ids_cache_entries", "/ids response cache size", lambda: len(ids_cache))
+
+def ids_response(cache: GuildCache, query: str):
+    """The /ids embed for query (None = no results), reused until the guild's data changes."""
+    # every lookup path lowercases, so case never changes the answer
+    key = (cache.guild_id, str(query).strip().lower())
+    embed = ids_cache.get(key, cache.generation)
+    if embed is not ResponseCache.MISS:
+        return embed
+
+    records = lookup_records(cache, query)
+    embed = None
+    if records:
+        pretty, ids_block = format_results(records)
+        embed = discord.Embed(title="✅ النتائج (كود | اسم | ID)")
+        embed.add_field(name=f"📌 العدد: {len(records)}", value=pretty, inline=False)
+        embed.add_field(name="📋 IDs فقط للنسخ", value=ids_block, inline=False)
+    ids_cache.put(key, cache.generation, embed)
+    return embed
 
 # =========================
 # Panel UI (Buttons + Modals)
 # =========================
+panels = {}  # guild_id -> (channel_id, message_id), mirrors guild_panels
+
+def _select_panels(conn):
+    c = conn.execute("SELECT guild_id, channel_id, message_id FROM guild_panels")
+    return {guild_id: (channel_id, message_id) for guild_id, channel_id, message_id in c}
+
+def _save_panel(conn, guild_id: int, channel_id: int, message_id: int):
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO guild_panels (guild_id, channel_id, message_id) VALUES (?, ?, ?)",
+            (guild_id, channel_id, message_id)
+        )
+
+async def load_panels():
+    loaded = await db_read(_select_panels)
+    panels.clear()
+    panels.update(loaded)
+
+async def set_panel(guild_id: int, channel_id: int, message_id: int):
+    await db_write(_save_panel, guild_id, channel_id, message_id)
+    panels[guild_id] = (channel_id, message_id)
+
+def panel_config(guild) -> tuple:
+    """(channel_id, message_id) of the guild's panel; 0 where none is set."""
+    if guild is None:
+        return 0, 0
+    if guild.id in panels:
+        return panels[guild.id]
+    if PANEL_CHANNEL_ID and guild.get_channel(PANEL_CHANNEL_ID):
+        return PANEL_CHANNEL_ID, PANEL_MESSAGE_ID  # env setup from before per-guild panels
+    return 0, 0
+
+def in_panel_channel(interaction: discord.Interaction) -> bool:
+    channel_id, _ = panel_config(interaction.guild)
+    return (not channel_id) or (interaction.channel_id == channel_id)
+
 class AddModal(discord.ui.Modal, title="➕ إضافة (ID الاسم الكود)"):
     data = discord.ui.TextInput(
         label="الصق البيانات (سطر لكل شخص) أو سطر واحد طويل",
@@ -323,8 +3009,9 @@ class AddModal(discord.ui.Modal, title="➕ إضافة (ID الاسم الكود
         max_length=4000
     )
 
+    @instrumented("modal:add")
     async def on_submit(self, interaction: discord.Interaction):
-        ok, bad, bad_lines = bulk_upsert(str(self.data))
+        ok, bad, bad_lines = await bulk_upsert(interaction.guild_id, str(self.data))
         msg = f"✅ تمت إضافة/تحديث: {ok}\n❌ سجلات فشلت: {bad}"
         if bad_lines:
             msg += "\n\nأول أخطاء:\n```" + "\n".join(bad_lines[:5]) + "```"
@@ -338,19 +3025,21 @@ class DeleteModal(discord.ui.Modal, title="🗑️ حذف (اسم أو كود)")
         max_length=4000
     )
 
+    @instrumented("modal:delete")
     async def on_submit(self, interaction: discord.Interaction):
-        ok, bad = delete_many(str(self.data))
-        load_cache()
-        await interaction.response.send_message(f"🗑️ تم حذف: {ok}\n❌ لم يُعثر على: {bad}", ephemeral=True)
+        await interaction_cache(interaction, ephemeral=True, thinking=True)
+        ok, bad = await delete_many(interaction.guild_id, str(self.data))
+        await respond(interaction, content=f"🗑️ تم حذف: {ok}\n❌ لم يُعثر على: {bad}", ephemeral=True)
 
 class PanelView(discord.ui.View):
     def __init__(self):
         super().__init__(timeout=None)
 
     def _check_channel(self, interaction: discord.Interaction) -> bool:
-        return (not PANEL_CHANNEL_ID) or (interaction.channel_id == PANEL_CHANNEL_ID)
+        return in_panel_channel(interaction)
 
     @discord.ui.button(label="➕ إضافة (مجموعة/اسم)", style=discord.ButtonStyle.success, custom_id="panel:add")
+    @instrumented("button:add")
     async def add_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
         if not self._check_channel(interaction):
             await interaction.response.send_message("❌ استخدم اللوحة في الروم المخصص فقط.", ephemeral=True)
@@ -361,6 +3050,7 @@ class PanelView(discord.ui.View):
         await interaction.response.send_modal(AddModal())
 
     @discord.ui.button(label="🗑️ حذف (مجموعة/اسم)", style=discord.ButtonStyle.danger, custom_id="panel:delete")
+    @instrumented("button:delete")
     async def delete_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
         if not self._check_channel(interaction):
             await interaction.response.send_message("❌ استخدم اللوحة في الروم المخصص فقط.", ephemeral=True)
@@ -371,73 +3061,94 @@ class PanelView(discord.ui.View):
         await interaction.response.send_modal(DeleteModal())
 
     @discord.ui.button(label="📋 عرض الأسماء", style=discord.ButtonStyle.primary, custom_id="panel:list")
+    @instrumented("button:list")
     async def list_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
         if not self._check_channel(interaction):
             await interaction.response.send_message("❌ استخدم اللوحة في الروم المخصص فقط.", ephemeral=True)
             return
 
-        records = list_all_records()
+        cache = await interaction_cache(interaction, ephemeral=True, thinking=True)
+        records, start, total = list_page(cache)
         if not records:
-            await interaction.response.send_message("لا يوجد بيانات حاليًا.", ephemeral=True)
+            await respond(interaction, content="لا يوجد بيانات حاليًا.", ephemeral=True)
             return
 
-        lines = []
-        ids_only = []
-        for n, c, uid in records[:40]:
-            lines.append(f"{c or '-'} | {n} | {uid}")
-            ids_only.append(uid)
-
-        embed = discord.Embed(title="📋 قائمة البيانات (أول 40)")
-        embed.add_field(name="كود | اسم | ID", value="```" + "\n".join(lines) + "```", inline=False)
-        embed.add_field(name="IDs فقط للنسخ", value="```" + "\n".join(ids_only) + "```", inline=False)
-        embed.set_footer(text=f"الإجمالي: {len(records)} | للتصدير الكامل اضغط 📤 تصدير TXT")
-        await interaction.response.send_message(embed=embed, ephemeral=True)
+        embed, view = render_list_page(records, start, total)
+        await respond(interaction, embed=embed, view=view, ephemeral=True)
 
     @discord.ui.button(label="📤 تصدير TXT", style=discord.ButtonStyle.secondary, custom_id="panel:export")
+    @instrumented("button:export")
     async def export_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
         if not self._check_channel(interaction):
             await interaction.response.send_message("❌ استخدم اللوحة في الروم المخصص فقط.", ephemeral=True)
             return
 
-        records = list_all_records()
-        if not records:
-            await interaction.response.send_message("لا توجد بيانات للتصدير.", ephemeral=True)
-            return
-
-        lines = ["code\tname\tid"]
-        for n, c, uid in records:
-            lines.append(f"{c or ''}\t{n}\t{uid}")
-        content = "\n".join(lines)
-
-        file = discord.File(fp=BytesIO(content.encode("utf-8")), filename="ids.txt")
-        await interaction.response.send_message("📄 تم إنشاء ملف التصدير:", file=file, ephemeral=True)
+        await send_export(interaction)
 
 # =========================
-# Events
+# Startup + events
 # =========================
+_lag_task = None
+_db_ready = False  # DB migrated and panels loaded in this process
+_started_at = time.monotonic()
+
+def command_tree_hash() -> str:
+    payload = [cmd.to_dict(bot.tree) for cmd in bot.tree.get_commands()]
+    payload.sort(key=lambda d: (d.get("type", 1), d["name"]))
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+async def sync_commands(force: bool = False) -> bool:
+    """Global sync, skipped when the tree matches what was last synced for this app."""
+    key = f"command_tree_hash:{bot.application_id}"
+    digest = command_tree_hash()
+    if not force and await get_meta(key) == digest:
+        return False
+    await bot.tree.sync()
+    await set_meta(key, digest)
+    return True
+
+async def setup_hook():
+    # runs once per login, before the gateway connects; guild caches load on first use
+    global _db_ready, _lag_task, _cache_task
+    outbound.reset()
+    if not _db_ready:
+        await init_db()
+        await load_panels()
+        _db_ready = True
+    bot.add_view(PanelView())  # keep buttons alive after restart
+    bot.add_dynamic_items(ListPageButton)
+    if _lag_task is None or _lag_task.done():
+        _lag_task = asyncio.create_task(watch_loop_lag())
+    if _cache_task is None or _cache_task.done():
+        _cache_task = asyncio.create_task(cache_loop())
+    synced = await sync_commands()
+    print("🌐 Slash commands synced" if synced else "🌐 Slash commands unchanged, sync skipped")
+
+bot.setup_hook = setup_hook
+
 @bot.event
 async def on_ready():
-    init_db()
-    load_cache()
-    bot.add_view(PanelView())  # keep buttons alive after restart
-    await bot.tree.sync()
+    # fires again after every gateway re-identify; keep it light
     await bot.change_presence(activity=discord.Game(name="لوحة IDs | /panel"))
-    print(f"🤖 Logged in as {bot.user}")
+    print(f"🤖 Logged in as {bot.user} ({time.monotonic() - _started_at:.1f}s since start)")
+    await adopt_on_ready()
 
 # =========================
 # SLASH COMMANDS
 # =========================
 @bot.tree.command(name="panel", description="إنشاء/تحديث لوحة التحكم في الروم المحدد (إدمن فقط)")
-async def panel_cmd(interaction: discord.Interaction):
+@app_commands.describe(channel="روم اللوحة (الافتراضي: الروم المحفوظ أو الروم الحالي)")
+@app_commands.guild_only()
+@instrumented("slash:panel")
+async def panel_cmd(interaction: discord.Interaction, channel: discord.TextChannel = None):
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("❌ هذا الأمر للإدمن فقط.", ephemeral=True)
         return
 
-    if not PANEL_CHANNEL_ID:
-        await interaction.response.send_message("❌ PANEL_CHANNEL_ID غير مضبوط في Render.", ephemeral=True)
-        return
-
-    channel = interaction.guild.get_channel(PANEL_CHANNEL_ID)
+    channel_id, message_id = panel_config(interaction.guild)
+    if channel is not None and channel.id != channel_id:
+        channel_id, message_id = channel.id, 0  # moved: post a new panel there
+    channel = interaction.guild.get_channel(channel_id or interaction.channel_id)
     if not channel:
         await interaction.response.send_message("❌ ما قدرت أوصل للروم. تأكد من Channel ID وصلاحيات البوت.", ephemeral=True)
         return
@@ -452,93 +3163,399 @@ async def panel_cmd(interaction: discord.Interaction):
         "\nملاحظة: الإضافة/الحذف للإدمن فقط."
     )
 
-    if PANEL_MESSAGE_ID:
+    # the edit/send is paced by the outbound scheduler, so answer the interaction first
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    if message_id:
         try:
-            msg = await channel.fetch_message(PANEL_MESSAGE_ID)
-            await msg.edit(content=content, view=view)
-            await interaction.response.send_message("✅ تم تحديث اللوحة.", ephemeral=True)
+            await outbound.run(
+                route_key("PATCH", f"/channels/{channel.id}/messages/{message_id}"),
+                lambda: channel.get_partial_message(message_id).edit(content=content, view=view),
+                key=("panel", message_id),  # repeated /panel calls collapse into one edit
+            )
+            await set_panel(interaction.guild_id, channel.id, message_id)
+            await interaction.followup.send("✅ تم تحديث اللوحة.", ephemeral=True)
+            return
+        except discord.NotFound:
+            pass  # the panel message was deleted: post a new one
+        except discord.HTTPException as e:
+            # still there, just not editable right now: a new post would leave two panels
+            print(f"⚠️ Panel edit failed in guild {interaction.guild_id}:", repr(e))
+            await interaction.followup.send("❌ ما قدرت أحدث اللوحة الحين، جرب مرة ثانية بعد شوي.", ephemeral=True)
             return
-        except Exception:
-            pass
 
-    msg = await channel.send(content, view=view)
-    await interaction.response.send_message(
-        f"✅ تم إنشاء اللوحة.\nانسخ Message ID هذا وضعه في Render كـ PANEL_MESSAGE_ID:\n`{msg.id}`",
-        ephemeral=True
+    msg = await outbound.run(
+        route_key("POST", f"/channels/{channel.id}/messages"),
+        lambda: channel.send(content, view=view),
     )
+    await set_panel(interaction.guild_id, channel.id, msg.id)
+    await interaction.followup.send(f"✅ تم إنشاء اللوحة في {channel.mention}.", ephemeral=True)
 
 @bot.tree.command(name="ids", description="بحث ID بالاسم أو الكود (يدعم أكثر من عنصر)")
 @app_commands.describe(query="مثال: فهد الدوسري c-61 H-07")
+@app_commands.guild_only()
+@instrumented("slash:ids")
 async def slash_ids(interaction: discord.Interaction, query: str):
-    records = lookup_records(query)
-    if not records:
-        await interaction.response.send_message("❌ ما لقيت نتائج.", ephemeral=True)
+    embed = ids_response(await interaction_cache(interaction, thinking=True), query)
+    if embed is None:
+        # after a cold-load defer the followup takes over the public "thinking" message
+        await respond(interaction, content="❌ ما لقيت نتائج.", ephemeral=not interaction.response.is_done())
         return
+    await respond(interaction, embed=embed, ephemeral=False)
+
+@slash_ids.autocomplete("query")
+@instrumented("autocomplete:ids")
+async def ids_autocomplete(interaction: discord.Interaction, current: str):
+    # prefix ranges over the in-memory index only, never SQLite
+    cache = caches.get(interaction.guild_id)
+    if cache is None:
+        _load_task(interaction.guild_id)  # warm it for the command itself
+        return []
+    cache.last_used = time.monotonic()
+    search_index, store = cache.search_index, cache.store
+    if not current.strip():
+        return []
 
-    pretty, ids_block = format_results(records)
-    embed = discord.Embed(title="✅ النتائج (كود | اسم | ID)")
-    embed.add_field(name=f"📌 العدد: {len(records)}", value=pretty, inline=False)
-    embed.add_field(name="📋 IDs فقط للنسخ", value=ids_block, inline=False)
-    await interaction.response.send_message(embed=embed, ephemeral=False)
+    head, tail = "", current.strip()
+    refs = search_index.search(tail, AUTOCOMPLETE_LIMIT, fuzzy=False)
+    if not refs and " " in tail:
+        # several items typed: complete the last one and keep the rest
+        head, tail = tail.rsplit(" ", 1)
+        head += " "
+        refs = search_index.search(tail, AUTOCOMPLETE_LIMIT, fuzzy=False)
+
+    choices = []
+    seen = set()
+    for kind, key in refs:
+        rec = store.get(kind, key)
+        value = head + key
+        if not rec or rec[0] in seen or len(value) > 100:
+            continue
+        seen.add(rec[0])
+        choices.append(app_commands.Choice(name=f"{rec[1] or '-'} | {rec[0]}"[:100], value=value))
+    return choices
+
+@bot.tree.command(name="whois", description="بحث عكسي: الصق IDs أو منشنات وارجع الأسماء والأكواد")
+@app_commands.describe(ids="IDs أو منشنات (حتى 100)، بأي فاصل")
+@app_commands.guild_only()
+@instrumented("slash:whois")
+async def slash_whois(interaction: discord.Interaction, ids: str):
+    found, missing, skipped = whois_records(await interaction_cache(interaction, thinking=True), ids)
+    if not found and not missing:
+        # after a cold-load defer the followup takes over the public "thinking" message
+        await respond(interaction, content="❌ ما لقيت أي ID صحيح.", ephemeral=not interaction.response.is_done())
+        return
+    embed, file = render_whois(found, missing, skipped)
+    if file:
+        await respond(interaction, embed=embed, file=file, ephemeral=False)
+    else:
+        await respond(interaction, embed=embed, ephemeral=False)
+
+@bot.tree.command(name="export", description="تصدير كل البيانات كملف (TXT/CSV/JSONL، مع ضغط اختياري)")
+@app_commands.describe(
+    fmt="صيغة الملف", gz="ضغط الملف (gzip)",
+    since="التغييرات فقط بعد رقم التسلسل من آخر تصدير، أو بعد تاريخ (مثل 2024-05-01)",
+)
+@app_commands.choices(fmt=[
+    app_commands.Choice(name="TXT (TSV)", value="tsv"),
+    app_commands.Choice(name="CSV", value="csv"),
+    app_commands.Choice(name="JSONL", value="jsonl"),
+])
+@app_commands.guild_only()
+@instrumented("slash:export")
+async def slash_export(interaction: discord.Interaction, fmt: str = "tsv", gz: bool = False, since: str = None):
+    if not in_panel_channel(interaction):
+        await interaction.response.send_message("❌ استخدم اللوحة في الروم المخصص فقط.", ephemeral=True)
+        return
+    if since is not None:
+        since = parse_since(since)
+        if since is None:
+            await interaction.response.send_message(
+                "❌ since لازم يكون رقم تسلسل أو تاريخ مثل 2024-05-01.", ephemeral=True
+            )
+            return
+    await send_export(interaction, fmt, gz, since)
 
 @bot.tree.command(name="bulkadd", description="إضافة/تحديث جماعي - للإدمن فقط")
 @app_commands.describe(data="الصق البيانات (حتى لو بسطر واحد): ID الاسم الكود ...")
+@app_commands.guild_only()
+@instrumented("slash:bulkadd")
 async def slash_bulkadd(interaction: discord.Interaction, data: str):
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("❌ هذا الأمر للإدمن فقط.", ephemeral=True)
         return
 
-    ok, bad, bad_lines = bulk_upsert(data)
+    ok, bad, bad_lines = await bulk_upsert(interaction.guild_id, data)
     msg = f"✅ تمت إضافة/تحديث: {ok}\n❌ سجلات فشلت: {bad}"
     if bad_lines:
         msg += "\n\nأول أخطاء:\n```" + "\n".join(bad_lines[:5]) + "```"
     await interaction.response.send_message(msg, ephemeral=True)
 
+@bot.tree.command(name="importfile", description="استيراد IDs من ملف (txt/csv/tsv) - للإدمن فقط")
+@app_commands.describe(file="ملف بسطور: ID الاسم الكود (أو ملف تصدير البوت)")
+@app_commands.guild_only()
+@instrumented("slash:importfile")
+async def slash_importfile(interaction: discord.Interaction, file: discord.Attachment):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ هذا الأمر للإدمن فقط.", ephemeral=True)
+        return
+    if not file.filename.lower().endswith(IMPORT_EXTENSIONS):
+        await interaction.response.send_message("❌ الملف لازم يكون txt أو csv أو tsv أو jsonl.", ephemeral=True)
+        return
+    if file.size > IMPORT_MAX_BYTES:
+        await interaction.response.send_message(f"❌ الملف أكبر من {IMPORT_MAX_BYTES // 2**20}MB.", ephemeral=True)
+        return
+    await import_attachment(interaction, file)
+
 # =========================
 # PREFIX COMMANDS (!)
 # =========================
 @bot.command(name="ids")
+@commands.guild_only()
+@instrumented("prefix:ids")
 async def prefix_ids(ctx, *, query: str):
-    records = lookup_records(query)
-    if not records:
+    embed = ids_response(await get_cache(ctx.guild.id), query)
+    if embed is None:
         await ctx.send("❌ ما لقيت نتائج.")
         return
-    pretty, ids_block = format_results(records)
-    embed = discord.Embed(title="✅ النتائج (كود | اسم | ID)")
-    embed.add_field(name=f"📌 العدد: {len(records)}", value=pretty, inline=False)
-    embed.add_field(name="📋 IDs فقط للنسخ", value=ids_block, inline=False)
     await ctx.send(embed=embed)
 
+@bot.command(name="whois")
+@commands.guild_only()
+@instrumented("prefix:whois")
+async def prefix_whois(ctx, *, ids: str):
+    found, missing, skipped = whois_records(await get_cache(ctx.guild.id), ids)
+    if not found and not missing:
+        await ctx.send("❌ ما لقيت أي ID صحيح.")
+        return
+    embed, file = render_whois(found, missing, skipped)
+    if file:
+        await ctx.send(embed=embed, file=file)
+    else:
+        await ctx.send(embed=embed)
+
 @bot.command(name="bulkadd")
+@commands.guild_only()
 @commands.has_permissions(administrator=True)
+@instrumented("prefix:bulkadd")
 async def prefix_bulkadd(ctx, *, data: str):
-    ok, bad, _ = bulk_upsert(data)
+    ok, bad, _ = await bulk_upsert(ctx.guild.id, data)
     await ctx.send(f"✅ تمت إضافة/تحديث: {ok}\n❌ سجلات فشلت: {bad}")
 
+@bot.command(name="reload")
+@commands.guild_only()
+@commands.has_permissions(administrator=True)
+@instrumented("prefix:reload")
+async def prefix_reload(ctx):
+    cache = await load_cache(ctx.guild.id)
+    await ctx.send(f"🔄 تم إعادة تحميل الكاش: {cache.store.count} اسم، {cache.store.code_count} كود")
+
+@bot.command(name="adopt")
+@commands.guild_only()
+@commands.is_owner()
+@instrumented("prefix:adopt")
+async def prefix_adopt(ctx):
+    # one-off: the rows saved before per-guild storage (when GUILD_ID was not set) join this guild
+    moved, skipped = await adopt_legacy(ctx.guild.id)
+    await ctx.send(f"📥 تم نقل {moved} سجل قديم لهذا السيرفر\n⚠️ مكرر وتم تجاهله: {skipped}")
+
+@bot.command(name="sync")
+@commands.has_permissions(administrator=True)
+@instrumented("prefix:sync")
+async def prefix_sync(ctx):
+    # forced: for when commands were changed outside the bot (e.g. in the developer portal)
+    await sync_commands(force=True)
+    await ctx.send("🌐 تمت مزامنة أوامر السلاش.")
+
+# =========================
+# Web server (health, metrics, lookup API)
+# =========================
+# Served on the bot's loop, and kept up while the bot reconnects or backs off.
+# /lookup resolves many names, codes and IDs per request from the guild's cache,
+# the same store and search index lookup_records uses; SQLite is only read when
+# the guild's cache is cold. Answers stream out in slices so a big batch never
+# holds the loop for long.
+API_MAX_KEYS = 10000             # keys per lookup request
+API_MAX_BODY = 4 * 1024 * 1024
+API_SLICE = 200                  # keys answered per write to the client
+WEB_KEEPALIVE = 75.0             # seconds an idle connection is kept open
+
+async def web_home(request: web.Request):
+    return web.Response(text="Bot is alive!")
+
+async def web_metrics(request: web.Request):
+    return web.Response(
+        body=metrics.render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+def lookup_key(cache: GuildCache, key: str, fuzzy: bool = False):
+    """Records for one key: an ID's records, else the exact name/code, else (fuzzy) ranked matches."""
+    store = cache.store
+    records = []
+    if is_valid_id(key):
+        rows = sorted(store.rows_of_uid(int(key)), key=store.order_key)
+        records = [store.record(row) for row in rows]
+    if not records:
+        rec = store.find(key)
+        if rec:
+            records = [rec]
+        elif fuzzy:
+            records = search_records(cache, key)
+    return records
+
+async def _lookup_args(request: web.Request):
+    """(guild_id, keys, fuzzy) from a JSON body, or from ?guild=&q=&q= on GET."""
+    if request.method == "POST":
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text="body must be JSON")
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text='body must be {"guild": ..., "keys": [...]}')
+        guild, keys, fuzzy = body.get("guild"), body.get("keys"), bool(body.get("fuzzy"))
+    else:
+        query = request.query
+        guild, keys, fuzzy = query.get("guild"), query.getall("q", []), query.get("fuzzy") in ("1", "true")
+    try:
+        guild_id = int(guild) if guild is not None else GUILD_ID
+    except (TypeError, ValueError):
+        raise web.HTTPBadRequest(text="guild must be a guild ID")
+    if not guild_id:
+        raise web.HTTPBadRequest(text="guild is required")
+    if not isinstance(keys, list) or not all(isinstance(k, (str, int)) for k in keys):
+        raise web.HTTPBadRequest(text="keys must be a list of names, codes or IDs")
+    if len(keys) > API_MAX_KEYS:
+        raise web.HTTPRequestEntityTooLarge(
+            max_size=API_MAX_KEYS, actual_size=len(keys), text=f"at most {API_MAX_KEYS} keys per request"
+        )
+    return guild_id, [str(k).strip() for k in keys], fuzzy
+
+@instrumented("http:lookup")
+async def web_lookup(request: web.Request):
+    if not API_TOKEN:
+        raise web.HTTPNotFound()
+    if not hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {API_TOKEN}".encode()):
+        raise web.HTTPUnauthorized(headers={"WWW-Authenticate": "Bearer"})
+    guild_id, keys, fuzzy = await _lookup_args(request)
+    cache = await get_cache(guild_id)
+    ndjson = request.query.get("format") == "ndjson" or "application/x-ndjson" in request.headers.get("Accept", "")
+
+    resp = web.StreamResponse(headers={
+        "Content-Type": "application/x-ndjson; charset=utf-8" if ndjson else "application/json; charset=utf-8",
+    })
+    await resp.prepare(request)
+    if not ndjson:
+        await resp.write(f'{{"guild":{guild_id},"results":['.encode())
+    found = 0
+    for start in range(0, len(keys), API_SLICE):
+        lines = []
+        for key in keys[start:start + API_SLICE]:
+            records = lookup_key(cache, key, fuzzy)
+            found += len(records)
+            matches = [{"name": n, "code": c, "id": uid} for n, c, uid in records]
+            lines.append(json.dumps({"key": key, "matches": matches}, ensure_ascii=False))
+        if ndjson:
+            chunk = "".join(line + "\n" for line in lines)
+        else:
+            chunk = ("," if start else "") + ",".join(lines)
+        await resp.write(chunk.encode("utf-8"))
+        await asyncio.sleep(0)  # write() only waits once the socket buffer is full; let other tasks run
+    if not ndjson:
+        await resp.write(b"]}\n")
+    await resp.write_eof()
+    count_rows(found)
+    return resp
+
+def make_web_app() -> web.Application:
+    app = web.Application(client_max_size=API_MAX_BODY)
+    app.router.add_get("/", web_home)
+    app.router.add_get("/metrics", web_metrics)
+    app.router.add_get("/lookup", web_lookup)
+    app.router.add_post("/lookup", web_lookup)
+    return app
+
+async def start_web() -> web.AppRunner:
+    site_runner = web.AppRunner(make_web_app(), keepalive_timeout=WEB_KEEPALIVE, access_log=None)
+    await site_runner.setup()
+    await web.TCPSite(site_runner, "0.0.0.0", int(os.getenv("PORT", "10000"))).start()
+    return site_runner
+
 # =========================
-# Run (anti-429 crash loop)
+# Run (restart with backoff)
 # =========================
-TOKEN = os.getenv("TOKEN")
-if not TOKEN:
-    raise RuntimeError("❌ TOKEN غير موجود في Render Environment Variables (KEY = TOKEN)")
+RESTART_MIN = 60.0
+RESTART_MAX = 20 * 60.0
+
+def is_rate_limit_error(e: discord.HTTPException) -> bool:
+    txt = str(e).lower()
+    return e.status == 429 or "rate limited" in txt or "cloudflare" in txt or "1015" in txt
 
-print("STARTING DISCORD BOT...")
+_stopping = None  # asyncio.Event set by SIGTERM: close cleanly and do not restart
 
-async def runner():
-    async with bot:
-        await bot.start(TOKEN, reconnect=True)
+def request_stop():
+    _stopping.set()
+    asyncio.create_task(bot.close())
 
-while True:
+async def runner(token: str):
+    if bot.is_closed():
+        bot.clear()  # a previous run closed the client; reopen it
     try:
-        asyncio.run(runner())
-    except discord.errors.HTTPException as e:
-        txt = str(e).lower()
-        if "429" in txt or "rate limited" in txt or "cloudflare" in txt or "1015" in txt:
-            print("⚠️ Discord/Cloudflare rate limit. Sleeping 20 minutes then retry...")
-            time.sleep(20 * 60)
-            continue
-        raise
-    except Exception as e:
-        print("❌ Unexpected error:", repr(e))
-        time.sleep(60)
-        continue
+        async with bot:
+            await bot.start(token, reconnect=True)
+    finally:
+        await journal.flush()  # queued writes reach SQLite before the bot restarts or the loop goes away
+
+async def serve(token: str):
+    # one loop for the web server and every bot run: the health check keeps answering
+    # during the backoff, and tasks started by setup_hook stay on a live loop
+    global _stopping
+    _stopping = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, request_stop)
+    except NotImplementedError:
+        pass  # Windows: only Ctrl+C
+    site_runner = await start_web()
+    print("STARTING DISCORD BOT...")
+
+    # the DB, cache and command hash survive a restart, so retrying is cheap;
+    # wait what Discord asked for (or back off exponentially), never a flat 20 minutes
+    attempt = 0
+    try:
+        while not _stopping.is_set():
+            started = time.monotonic()
+            try:
+                await runner(token)
+                continue
+            except discord.RateLimited as e:
+                wait = e.retry_after
+                print(f"⚠️ Discord rate limit ({wait:.0f}s).")
+            except discord.errors.HTTPException as e:
+                if not is_rate_limit_error(e):
+                    raise
+                wait = _retry_after(e.response.headers) if e.response is not None else 0.0
+                print(f"⚠️ Discord/Cloudflare rate limit (Retry-After {wait:.0f}s).")
+            except Exception as e:
+                print("❌ Unexpected error:", repr(e))
+                wait = 0.0
+            if _stopping.is_set():
+                break
+            if time.monotonic() - started > RESTART_MAX:
+                attempt = 0  # it ran fine for a while; start the backoff over
+            wait = jittered(max(wait, min(RESTART_MIN * 2 ** attempt, RESTART_MAX)))
+            attempt += 1
+            print(f"🔁 Retrying in {wait:.0f}s...")
+            try:
+                await asyncio.wait_for(_stopping.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        await site_runner.cleanup()
+
+if __name__ == "__main__":
+    TOKEN = os.getenv("TOKEN")
+    if not TOKEN:
+        raise RuntimeError("❌ TOKEN غير موجود في Render Environment Variables (KEY = TOKEN)")
+
+    asyncio.run(serve(TOKEN))
+    stop_db()  # lets the writer thread finish what it was handed
+    print("👋 Stopped")
@@ -0,0 +1,18 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main
+from benchmark import use_db
+
+
+@pytest.fixture
+def db(tmp_path):
+    """main's DB layer on a fresh file, stopped again afterwards."""
+    path = str(tmp_path / "test.db")
+    use_db(path)
+    yield path
+    main.stop_db()
@@ -0,0 +1,31 @@
+import asyncio
+from types import SimpleNamespace
+
+import main
+from benchmark import GUILD, make_rows
+
+
+def legacy_db(rows):
+    async def run():
+        await main.init_db()
+        await main.journal.write(0, "upsert", rows)  # what v5 left behind without GUILD_ID
+    asyncio.run(run())
+
+
+def test_only_guild_adopts_unassigned_rows(db, monkeypatch):
+    rows = make_rows(50)
+    legacy_db(rows)
+    monkeypatch.setattr(type(main.bot), "guilds", [SimpleNamespace(id=GUILD, name="only")])
+    asyncio.run(main.adopt_on_ready())
+    assert sorted(asyncio.run(main.list_all_records(GUILD))) == sorted(rows)
+    assert asyncio.run(main.list_all_records(0)) == []
+
+
+def test_unassigned_rows_stay_put_with_several_guilds(db, monkeypatch, capsys):
+    legacy_db(make_rows(50))
+    guilds = [SimpleNamespace(id=GUILD, name="a"), SimpleNamespace(id=GUILD + 1, name="b")]
+    monkeypatch.setattr(type(main.bot), "guilds", guilds)
+    asyncio.run(main.adopt_on_ready())
+    assert "GUILD_ID" in capsys.readouterr().out
+    assert len(asyncio.run(main.list_all_records(0))) == 50
+    assert asyncio.run(main.list_all_records(GUILD)) == []
@@ -0,0 +1,29 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+import main
+from benchmark import GUILD, bulk_text, make_rows
+
+
+def test_failed_download_leaves_committed_batches_in_the_cache(db):
+    rows = make_rows(2 * main.IMPORT_BATCH + 10)
+    data = bulk_text(rows).encode("utf-8")
+
+    async def chunks():
+        yield data
+        raise aiohttp.ClientPayloadError("connection lost")
+
+    async def run():
+        await main.init_db()
+        await main.get_cache(GUILD)
+        with pytest.raises(aiohttp.ClientPayloadError):
+            await main.import_stream(GUILD, chunks())
+        await main.journal.flush()
+        return await main.list_all_records(GUILD), main.caches[GUILD]
+
+    records, cache = asyncio.run(run())
+    assert len(records) == 2 * main.IMPORT_BATCH  # the whole batches were committed
+    assert cache.store.count == len(records)
+    assert not cache.lagging and cache.rev is not None
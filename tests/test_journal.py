@@ -0,0 +1,64 @@
+import asyncio
+
+import main
+from benchmark import GUILD, make_rows
+
+
+def test_acknowledged_writes_survive_a_crash(db, monkeypatch):
+    rows = make_rows(3000)
+    acked, lost = rows[:2000], rows[2000:]
+    monkeypatch.setattr(main, "journal", main.WriteJournal())  # this one is left with writes it never commits
+
+    async def run():
+        await main.init_db()
+        await main.get_cache(GUILD)
+        # acknowledged: each write has returned, i.e. its group is committed
+        await asyncio.gather(
+            main.journal.write(GUILD, "upsert", acked[:1000]),
+            main.journal.write(GUILD, "upsert", acked[1000:]),
+        )
+        await main.journal.write(GUILD, "delete", acked[:100])
+
+        # not acknowledged: queued, then the process dies before the group commits
+        main.journal.submit(GUILD, "upsert", lost)
+        main.journal.submit(GUILD, "delete", acked[100:200])
+        task = main.journal._task
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+        # restart: nothing in memory, reload from SQLite
+        main.journal = main.WriteJournal()
+        main.caches.clear()
+        main._latest_rev.clear()
+        main.stop_db()
+        main.start_db()
+        cache = await main.get_cache(GUILD)
+        return await main.list_all_records(GUILD), cache
+
+    records, cache = asyncio.run(run())
+    expected = set(acked[100:])
+    assert set(records) == expected
+    assert {cache.store.record(row) for row in cache.store.rows()} == expected
+
+
+def test_delete_racing_a_patching_upsert_keeps_cache_and_db_alike(db, monkeypatch):
+    rows = make_rows(1000)
+    monkeypatch.setattr(main, "CACHE_PATCH_SLICE", 0.0)  # the upsert lets the loop go after every chunk
+
+    async def run():
+        await main.init_db()
+        await main.upsert_many(GUILD, rows[:100])
+        await main.get_cache(GUILD)
+        changed = [(name, code, str(int(uid) + 1)) for name, code, uid in rows[:100]] + rows[100:900]
+        upsert = asyncio.create_task(main.upsert_many(GUILD, changed))
+        await asyncio.sleep(0)  # the upsert holds the turn, part way through its patch
+        deleted, _ = await main.delete_many(GUILD, rows[50][0])
+        await upsert
+        await main.journal.flush()
+        cache = main.caches[GUILD]
+        return deleted, await main.list_all_records(GUILD), {cache.store.record(r) for r in cache.store.rows()}
+
+    deleted, records, cached = asyncio.run(run())
+    assert deleted == 1
+    assert set(records) == cached
+    assert all(name != rows[50][0] for name, _, _ in records)
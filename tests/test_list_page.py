@@ -0,0 +1,58 @@
+from array import array
+
+import main
+
+
+def make_cache(rows):
+    store = main.RecordStore()
+    store.extend(rows)
+    order = array("I", sorted(store.rows(), key=store.order_key))
+    return main.GuildCache(1, store, main._build_index(store), order, 0)
+
+
+def long_rows(n):
+    # names and codes longer than a custom_id can carry, sharing their first 90+ chars
+    pad = "x" * 120
+    rows = [(f"{pad} name {i:03}", None, str(10 ** 17 + i)) for i in range(n)]
+    rows += [(f"n{i}", f"{pad}-{i:03}", str(2 * 10 ** 17 + i)) for i in range(n)]
+    return rows
+
+
+def page_forward(cache, size):
+    seen = []
+    records, _, _ = main.list_page(cache, size=size)
+    while records:
+        seen += records
+        cursor = main._cursor_of(records[-1])
+        records, _, _ = main.list_page(cache, after=main._cursor_key(cache, *cursor), size=size)
+    return seen
+
+
+def test_long_keys_page_through_every_row_once():
+    rows = long_rows(25)
+    cache = make_cache(rows)
+    seen = page_forward(cache, size=7)
+    assert len(seen) == len(rows)
+    assert sorted(seen) == sorted(rows)
+
+
+def test_long_key_cursor_survives_rows_added_before_it():
+    cache = make_cache(long_rows(10))
+    records, _, _ = main.list_page(cache, size=5)
+    cursor = main._cursor_of(records[-1])
+    assert cursor[0] == "h"
+    main._cache_put(cache, ("0", "0", str(3 * 10 ** 17)))  # sorts first, shifting every position
+    after, _, _ = main.list_page(cache, after=main._cursor_key(cache, *cursor), size=5)
+    before, _, _ = main.list_page(cache, before=main._cursor_key(cache, *cursor), size=5)
+    assert after[0] == cache.store.record(cache.list_order[6])
+    assert before[-1] == records[-2]
+
+
+def test_long_key_cursor_of_a_removed_row_skips_nothing():
+    cache = make_cache(long_rows(10))
+    records, _, _ = main.list_page(cache, size=5)
+    cursor = main._cursor_of(records[-1])
+    main._cache_drop(cache, records[-1])
+    after, _, _ = main.list_page(cache, after=main._cursor_key(cache, *cursor), size=20)
+    rest = [cache.store.record(row) for row in cache.list_order[4:]]
+    assert set(rest) <= set(after)
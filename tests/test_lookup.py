@@ -0,0 +1,30 @@
+from array import array
+
+import main
+from benchmark import make_rows, sample_queries
+
+
+def make_cache(rows):
+    store = main.RecordStore()
+    store.extend((main.normalize_name(n), main.normalize_code(c), uid) for n, c, uid in rows)
+    return main.GuildCache(1, store, main._build_index(store), None, 0)
+
+
+def test_prefix_match_on_name_and_code_lists_record_once():
+    cache = make_cache([("Cat", "C-1", "123456789012345678")])
+    assert main.lookup_records(cache, "c") == [("cat", "c-1", "123456789012345678")]
+
+
+def test_index_updated_row_by_row_answers_like_a_rebuilt_one():
+    rows = make_rows(3000)
+    store = main.RecordStore()
+    cache = main.GuildCache(1, store, main.SearchIndex(store), array("I"), 0)
+    for rec in rows:  # enough entries to split the index blocks many times
+        main._cache_put(cache, rec)
+    for rec in rows[::3]:
+        main._cache_drop(cache, rec)
+    rebuilt = main._build_index(store)
+    assert len(cache.search_index) == len(rebuilt)
+    for queries in sample_queries(rows[1::3], count=50).values():
+        for q in queries:
+            assert cache.search_index.search(q) == rebuilt.search(q)
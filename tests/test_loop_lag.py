@@ -0,0 +1,35 @@
+import time
+import asyncio
+
+import main
+from benchmark import GUILD, make_rows
+from loadtest import LagProbe
+
+LAG_BOUND = 0.1  # seconds the loop may be held while SQLite works
+
+
+def test_db_work_keeps_the_loop_free(db):
+    rows = make_rows(100000)
+
+    async def run():
+        await main.init_db()
+        await main.get_cache(GUILD)  # loaded, so the writes patch it as they would in the bot
+        with LagProbe() as lag:
+            t0 = time.perf_counter()
+            await main.upsert_many(GUILD, rows)
+            await main.upsert_many(GUILD, rows)  # every row replaced
+            records = await main.list_all_records(GUILD)
+            elapsed = time.perf_counter() - t0
+            await asyncio.sleep(LagProbe.INTERVAL * 2)  # a wake-up after the work, should it have held the loop
+            # a batch small enough to be patched into the loaded cache row by row
+            small = [(name, code, str(int(uid) + 1)) for name, code, uid in rows[:2000]]
+            await main.upsert_many(GUILD, small)
+            await asyncio.sleep(LagProbe.INTERVAL * 2)
+        await main.journal.flush()
+        return elapsed, lag.samples, records, main.caches[GUILD].store.find(small[0][0])
+
+    elapsed, samples, records, patched = asyncio.run(run())
+    assert len(records) == len(rows)
+    assert patched[2] == str(int(rows[0][2]) + 1)
+    assert elapsed > 10 * LAG_BOUND  # enough work that a blocked loop would show
+    assert max(samples) < LAG_BOUND
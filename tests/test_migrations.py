@@ -0,0 +1,41 @@
+import sqlite3
+import asyncio
+
+import main
+from benchmark import GUILD, make_rows
+
+BAD_IDS = ["12345678901234567890123", "0123456789012345678"]  # over 64 bits, leading zero
+
+
+def insert_rows(path, rows):
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany("INSERT INTO users (guild_id, name, code, user_id) VALUES (?, ?, ?, ?)", rows)
+    return conn
+
+
+def test_ids_the_cache_cannot_hold_are_quarantined(db):
+    rows = make_rows(20)
+    asyncio.run(main.init_db())
+    conn = insert_rows(db, [(GUILD, f"bad {i}", f"b-{i}", uid) for i, uid in enumerate(BAD_IDS)])
+    with conn:
+        conn.execute("DROP TABLE users_quarantine")
+        conn.execute("PRAGMA user_version = 7")  # as a database from before v8
+
+    async def run():
+        await main.upsert_many(GUILD, rows)
+        await main.init_db()
+        return await main.get_cache(GUILD)
+
+    cache = asyncio.run(run())
+    assert cache.store.count == len(rows)
+    assert sorted(uid for uid, in conn.execute("SELECT user_id FROM users_quarantine")) == sorted(BAD_IDS)
+    assert conn.execute("SELECT count(*) FROM users WHERE guild_id = ?", (GUILD,)).fetchone()[0] == len(rows)
+
+
+def test_cache_loads_around_rows_it_cannot_hold(db):
+    rows = make_rows(20)
+    asyncio.run(main.init_db())
+    insert_rows(db, [(GUILD, n, c, uid) for n, c, uid in rows] + [(GUILD, "bad", "b-1", BAD_IDS[0])])
+    cache = asyncio.run(main.get_cache(GUILD))
+    assert sorted(cache.store.record(row) for row in cache.store.rows()) == sorted(rows)
@@ -0,0 +1,35 @@
+import asyncio
+
+import main
+
+
+def test_each_reply_token_keeps_its_own_route():
+    # Discord limits webhook ID + token together, so two replies never share a bucket
+    token = "aW50ZXJhY3Rpb246MTIzNDU2Nzg5MDEyMzQ1Njc4OnRva2Vu"
+    assert main.route_key("post", f"/api/v10/interactions/123456789012345678/{token}/callback") == (
+        f"POST /interactions/:id/{token}/callback"
+    )
+    assert main.route_key("PATCH", f"/webhooks/223456789012345678/{token}/messages/@original") == (
+        f"PATCH /webhooks/223456789012345678/{token}/messages/@original"
+    )
+    assert main.route_key("GET", "/channels/323456789012345678/messages/423456789012345678") == (
+        "GET /channels/323456789012345678/messages/:id"
+    )
+
+
+def test_idle_routes_are_forgotten(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    limits = main.RateLimits()
+    outbound = main.OutboundScheduler(limits)
+    for i in range(50):
+        limits.update("POST", f"/channels/{10 ** 17 + i}/messages", 200, {
+            "X-RateLimit-Bucket": f"b{i}", "X-RateLimit-Remaining": "1", "X-RateLimit-Reset-After": "1",
+        })
+        asyncio.run(outbound._wait(f"POST /channels/{10 ** 17 + i}/messages"))  # room left: no sleep
+    assert len(limits.bucket_of) == len(limits.buckets) == len(outbound.pacers) == 50
+
+    now[0] += main.RATE_IDLE
+    limits.update("GET", "/gateway/bot", 200, {})
+    outbound._prune(now[0])
+    assert not limits.bucket_of and not limits.buckets and not outbound.pacers
@@ -0,0 +1,57 @@
+import os
+import asyncio
+
+import pytest
+
+import main
+from benchmark import GUILD, make_rows
+
+
+def test_overlong_keys_are_rejected_before_any_column_changes():
+    long = "x" * (main.KEY_MAX_BYTES + 1)
+    uid = "123456789012345678"
+    records, bad = main.validate_entries([(uid, long, "c-1"), (uid, "cat", long), (uid, "cat", "c-1")])
+    assert records == [("cat", "c-1", uid)] and len(bad) == 2
+
+    store = main.RecordStore()
+    store.extend(records)
+    with pytest.raises(ValueError):
+        store.put("dog", long, uid)
+    with pytest.raises(ValueError):
+        store.extend([("dog", "d-1", uid), (long, "e-1", uid)])
+    row = store.put("emu", "e-2", uid)
+    # the columns stayed aligned: every row reads back as written
+    assert [store.record(r) for r in store.rows()] == [("cat", "c-1", uid), ("dog", "d-1", uid), ("emu", "e-2", uid)]
+    assert store.record(row) == ("emu", "e-2", uid)
+
+
+def test_snapshot_keeps_a_long_free_list(tmp_path):
+    store = main.RecordStore()
+    store.extend((f"name {i}", f"c-{i}", str(10 ** 17 + i)) for i in range(30000))
+    for row in range(0, 30000, 2):
+        store.drop(row)
+    columns, scalars = store.snapshot_state()
+    assert main._write_snapshot(str(tmp_path / "snap"), 1, 1, 1, columns, scalars)
+    copy = main.RecordStore.from_snapshot(columns, scalars)
+    assert copy._free == store._free
+    assert copy.put("new", "c-new", "123456789012345678") == store._free[-1]
+
+
+def test_truncated_snapshot_is_rebuilt_from_the_db(db):
+    rows = make_rows(20000)
+
+    async def run():
+        await main.init_db()
+        await main.upsert_many(GUILD, rows)
+        cache = await main.get_cache(GUILD)
+        await main.journal.flush()
+        assert await main.save_snapshot(cache)
+        path = main.snapshot_path(GUILD)
+        with open(path, "r+b") as f:  # a write cut short
+            f.truncate(os.path.getsize(path) - 4 * main.SNAPSHOT_ALIGN)
+        main.caches.clear()
+        assert not await main.load_snapshot(GUILD)
+        return await main.get_cache(GUILD)
+
+    cache = asyncio.run(run())
+    assert cache.store.count == len(cache.list_order) == len(rows)